@@ -0,0 +1,99 @@
+"""Wire encodings for calls between the hub and domains, negotiated with JSON as the fallback
+
+JSON always works. If msgpack or cbor2 is installed (see requirements.txt),
+bodies may instead be sent as application/msgpack or application/cbor, which
+are smaller and cheaper to encode and decode. Each side lists the types it can read when the domain
+registers (the "codecs" field, from available), and sends the other the first
+of those it can also write, as picked by pick().
+
+Receivers decode by Content-Type, treating anything unrecognised as JSON so
+browsers and older servers keep working, and answer in a type the Accept
+header asks for.
+
+JSON itself is handled by orjson or ujson when installed, else the standard
+library, always encoding straight to bytes; json_response() is a drop-in for
+aiohttp's that does so.
+"""
+from aiohttp import web
+import json
+
+try: import orjson
+except ImportError: orjson = None
+try: import ujson
+except ImportError: ujson = None
+try: import msgpack
+except ImportError: msgpack = None
+try: import cbor2
+except ImportError: cbor2 = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+# The fastest JSON implementation installed: dumps(data) -> bytes and loads(bytes or str)
+if orjson is not None:
+    json_implementation = 'orjson'
+    def dumps(data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    loads = orjson.loads
+elif ujson is not None:
+    json_implementation = 'ujson'
+    def dumps(data) -> bytes:
+        return ujson.dumps(data, ensure_ascii=False).encode()
+    loads = ujson.loads
+else:
+    json_implementation = 'json'
+    def dumps(data) -> bytes:
+        return json.dumps(data).encode()
+    loads = json.loads
+
+encoders = {JSON: dumps}
+decoders = {JSON: loads}
+if msgpack is not None:
+    encoders[MSGPACK] = msgpack.packb
+    decoders[MSGPACK] = lambda body: msgpack.unpackb(body, strict_map_key=False)
+if cbor2 is not None:
+    encoders[CBOR] = cbor2.dumps
+    decoders[CBOR] = cbor2.loads
+
+# Types this process can read and write, most preferred first
+available = [kind for kind in (MSGPACK, CBOR, JSON) if kind in encoders]
+
+
+def pick(theirs) -> str:
+    """The most preferred type that both this process and the other side (listing theirs) support"""
+    for kind in available:
+        if kind in theirs: return kind
+    return JSON
+
+def encode(data, kind:str=JSON) -> bytes:
+    return encoders[kind](data)
+
+def decode(body:bytes, kind:str) -> object:
+    """Parses a body of the given Content-Type; raises ValueError if it is malformed"""
+    try:
+        return decoders.get(kind, loads)(body)
+    except ValueError:
+        raise
+    except Exception as ex: # msgpack and cbor2 have their own exception types
+        raise ValueError(repr(ex)) from ex
+
+async def read(message) -> object:
+    """The decoded body of a web.Request or ClientResponse"""
+    return decode(await message.read(), message.content_type)
+
+def headers(kind:str) -> dict:
+    """Headers for sending a body of type kind and asking for an answer in the same type"""
+    return {'Content-Type':kind, 'Accept':kind if kind == JSON else kind+', '+JSON+';q=0.5'}
+
+def respond(req:web.Request, data, status:int=200) -> web.Response:
+    """A response encoded in the first available type the request's Accept header lists"""
+    accept = req.headers.get('Accept', '')
+    kind = next((kind for kind in available if kind in accept), JSON)
+    return web.Response(status=status, body=encode(data, kind), content_type=kind)
+
+def json_response(data=None, *, text:str|None=None, status:int=200, headers:dict|None=None) -> web.Response:
+    """Like web.json_response, but encoding data with the fastest JSON available"""
+    if text is not None:
+        return web.Response(text=text, status=status, headers=headers, content_type=JSON)
+    return web.Response(body=dumps(data), status=status, headers=headers, content_type=JSON)
@@ -0,0 +1,91 @@
+"""Benchmark of the wire encodings in codec.py on /arrive payloads with large inventories
+
+For each inventory size, builds the /arrive body the hub would send for a user
+carrying that many items (plus some dropped items and prizes), then reports its
+size and the time to encode and decode it in every available encoding. If
+codec.py found a faster JSON library than the standard one, the standard
+library is measured too, and the time it saves per request is summarised.
+
+    python codecbench.py
+    python codecbench.py --items 10 100 1000 10000 --repeat 200
+"""
+import json
+import random
+import time
+
+import codec
+import hub
+import newdomain
+
+
+def item(tid:int) -> dict:
+    """A brief like the hub's, with text like the items domains really register"""
+    source = newdomain.domain_items[tid % len(newdomain.domain_items)]
+    verbs = dict(random.sample(sorted(hub.item_verbs.items()), random.randrange(1, 4)))
+    return {'name':source['name']+str(tid), 'description':source['description'],
+        'verb':source.get('verb', {}) | {v:text.format(source['name']) for v,text in verbs.items()}, 'id':tid}
+
+def arrival(items:int) -> dict:
+    """An /arrive body for a user carrying items items, a quarter as many dropped, and three prizes"""
+    tids = iter(range(1000, 1000+items+items//4+3))
+    return {
+        'secret':hub.make_secret(),
+        'user':12345,
+        'from':'south',
+        'owned':[item(next(tids)) for _ in range(items//10)],
+        'carried':[item(next(tids)) for _ in range(items - items//10)],
+        'dropped':[item(next(tids)) | {'location':'puzzle_chamber_0'} for _ in range(items//4)],
+        'prize':[item(next(tids)) | {'depth':depth} for depth in range(3)],
+    }
+
+def best(fn, repeat:int) -> float:
+    """Fastest of repeat runs of fn, in seconds"""
+    fastest = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+def candidates() -> list[tuple]:
+    """(name, encode, decode) for every encoding to measure"""
+    found = [(kind.split('/')[1], codec.encoders[kind], codec.decoders[kind]) for kind in codec.available]
+    if codec.json_implementation != 'json':
+        found.append(('stdlib', lambda data: json.dumps(data).encode(), json.loads))
+    return found
+
+def run(sizes:list[int], repeat:int) -> list[dict]:
+    rows = []
+    for items in sizes:
+        data = arrival(items)
+        for name, encode, decode in candidates():
+            body = encode(data)
+            assert decode(body) == data, name
+            rows.append({'items':items, 'codec':name, 'bytes':len(body),
+                'encode_us':best(lambda: encode(data), repeat)*1e6,
+                'decode_us':best(lambda: decode(body), repeat)*1e6})
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000], help="inventory sizes to try")
+    parser.add_argument('--repeat', type=int, default=100, help="runs of each encode and decode; the fastest is reported")
+    args = parser.parse_args()
+
+    random.seed(0)
+    rows = run(args.items, args.repeat)
+    json_bytes = {row['items']:row['bytes'] for row in rows if row['codec'] == 'json'}
+    print(f'{"items":>6} {"codec":>8} {"bytes":>9} {"vs json":>8} {"encode µs":>10} {"decode µs":>10}')
+    for row in rows:
+        print(f'{row["items"]:>6} {row["codec"]:>8} {row["bytes"]:>9} {row["bytes"]/json_bytes[row["items"]]:>8.0%}'
+            f' {row["encode_us"]:>10.1f} {row["decode_us"]:>10.1f}')
+    print(f'\nJSON is handled by {codec.json_implementation}.')
+    if codec.json_implementation != 'json':
+        by = {(row['items'], row['codec']):row['encode_us']+row['decode_us'] for row in rows}
+        for items in args.items:
+            saved = by[items, 'stdlib'] - by[items, 'json']
+            print(f'Per request of {items} items, it saves {saved:.1f} µs ({saved/by[items, "stdlib"]:.0%}) of encoding and decoding.')
+    if len(codec.available) == 1:
+        print('Only JSON is available; install msgpack or cbor2 to compare.')
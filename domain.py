@@ -127,6 +127,27 @@ async def register_with_hub_server(req: Request) -> Response:
     if data['secret'] != base_domain_info['secret']:
         return json_response(status=403, data={'error': 'Invalid secret'})
     
+    return json_response(status=200, data={'unused_items_depth': arrive_user(data)})
+
+
+@routes.post('/arrive_batch')
+async def register_with_hub_server(req: Request) -> Response:
+    """Called by hub server with many arrivals at once, such as during a bulk login.
+
+    The payload is {'secret': ..., 'arrivals': [an /arrive payload without its secret, ...]}
+    """
+    data = await req.json()
+
+    # Verify secret matches
+    if data['secret'] != base_domain_info['secret']:
+        return json_response(status=403, data={'error': 'Invalid secret'})
+
+    arrived = [{'user': arrival['user'], 'unused_items_depth': arrive_user(arrival)} for arrival in data['arrivals']]
+    return json_response(status=200, data={'arrived': arrived})
+
+
+def arrive_user(data):
+    """Sets up or resets the state of one arriving user; returns the prize items that could not be placed"""
     user_id = data['user']
     user_state = None
     user_domain_state = None
@@ -217,7 +238,7 @@ async def register_with_hub_server(req: Request) -> Response:
             unused_depth.append(item)
             
     user_domain_state['user_state'] = user_state
-    return json_response(status=200, data={'unused_items_depth': unused_depth})
+    return unused_depth
 
 
 @routes.post('/dropped')
@@ -626,6 +647,25 @@ async def handle_command(req: Request) -> Response:
                return Response(text=found_item['verb'][verb])# For any other command
     return Response(text="I don't know how to do that.")
 
+@routes.get('/healthz')
+async def healthz(req: Request) -> Response:
+    """Liveness probe: answers whenever the server is accepting requests"""
+    return Response(text='ok')
+
+@routes.get('/readyz')
+async def readyz(req: Request) -> Response:
+    """Readiness probe: startup has finished by the time this answers; also says whether a hub has registered this domain"""
+    return json_response(data={'ready': True, 'registered': base_domain_info['domain_id'] is not None})
+
+def make_app():
+    """The domain's web application; allow_cors and the session hooks are defined below"""
+    app = web.Application(middlewares=[allow_cors])
+    app.on_startup.append(start_session)
+    app.on_shutdown.append(end_session)
+    app.add_routes(routes)
+    return app
+
+
 # Do not modify code below this line
 
 @web.middleware
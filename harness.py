@@ -0,0 +1,155 @@
+"""A hub and a domain server for tests, scenarios and benchmarks, without sleeping on startup
+
+In-process, both apps run on the caller's event loop on free ports, with fresh
+module state for each run:
+
+    async with harness.InProcess('newdomain') as game:
+        await game.play()
+        me = await game.login()
+        print(await game.command(me, 'look'))
+
+As subprocesses, the servers are started and waited on through /readyz:
+
+    with harness.Subprocesses('domain.py') as (hub_port, domain_port):
+        ...
+
+Either way, requests share one pooled ClientSession (game.client) rather than
+opening a connection each.
+"""
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+import asyncio
+import importlib
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Commands the hub answers; domains answer the rest
+hub_verbs = {'journey', 'region', 'inventory', 'score', 'drop'}
+
+
+async def ready(session:ClientSession, url:str, timeout:float=10.0) -> dict:
+    """Waits for url/readyz to answer 200, and returns what it said"""
+    give_up = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url+'/readyz') as resp:
+                if resp.status == 200: return await resp.json()
+        except OSError:
+            pass
+        if time.monotonic() > give_up:
+            raise TimeoutError(url+' did not become ready')
+        await asyncio.sleep(0.01)
+
+def wait_ready(url:str, timeout:float=10.0, proc:subprocess.Popen|None=None) -> dict:
+    """ready() for code without an event loop; gives up at once if proc, the server's process, has exited"""
+    give_up = time.monotonic() + timeout
+    while True:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f'{url} exited with code {proc.returncode} before becoming ready')
+        try:
+            with urllib.request.urlopen(url+'/readyz') as resp:
+                return json.loads(resp.read())
+        except OSError:
+            pass
+        if time.monotonic() > give_up:
+            raise TimeoutError(url+' did not become ready')
+        time.sleep(0.01)
+
+def free_port() -> int:
+    """A port nothing is listening on, as chosen by the OS"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def fresh(name:str):
+    """The named module with its global state reset"""
+    if name in sys.modules:
+        return importlib.reload(sys.modules[name])
+    return importlib.import_module(name)
+
+
+class InProcess:
+    """Runs the hub and a domain module (domain or newdomain) on the current event loop"""
+    def __init__(self, domain:str='newdomain', connections:int=100):
+        self.domain_name = domain
+        self.connections = connections
+
+    async def serve(self, app:web.Application) -> str:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        self.runners.append(runner)
+        return 'http://127.0.0.1:%d' % sock.getsockname()[1]
+
+    async def __aenter__(self) -> 'InProcess':
+        self.hub = fresh('hub')
+        self.domain = fresh(self.domain_name)
+        self.runners = []
+        self.hub_url = self.hub.whoami = await self.serve(self.hub.make_app())
+        self.domain_url = self.domain.whoami = await self.serve(self.domain.make_app())
+        self.client = ClientSession(connector=TCPConnector(limit=self.connections), timeout=ClientTimeout(total=10))
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.client.close()
+        for runner in reversed(self.runners):
+            await runner.cleanup()
+
+    async def post(self, url:str, data) -> tuple[int, object]:
+        """Posts str data as text and anything else as JSON; returns the status and parsed answer"""
+        kw = {'data':data} if isinstance(data, (str, bytes)) else {'json':data}
+        async with self.client.post(url, **kw) as resp:
+            text = await resp.text()
+        try: return resp.status, json.loads(text)
+        except ValueError: return resp.status, text
+
+    async def play(self) -> None:
+        """Registers the domain with the hub and starts play"""
+        status, answer = await self.post(self.hub_url+'/domain', self.domain_url)
+        assert status == 200, answer
+        status, answer = await self.post(self.hub_url+'/mode', 'play')
+        assert status == 200, answer
+
+    async def login(self) -> dict:
+        """A new user: the hub's /login answer"""
+        async with self.client.get(self.hub_url+'/login') as resp:
+            assert resp.status == 200, await resp.text()
+            return await resp.json()
+
+    async def command(self, me:dict, *words:str) -> object:
+        """Sends a command as user me to whichever server handles it"""
+        body = {'user':me['id'], 'command':list(words)}
+        if words[0] in hub_verbs:
+            return (await self.post(self.hub_url+'/command', body | {'secret':me['secret']}))[1]
+        if 'token' in me['domain']: body['token'] = me['domain']['token']
+        return (await self.post(me['domain']['url']+'/command', body))[1]
+
+
+class Subprocesses:
+    """Runs hub.py and a domain script as child processes on free ports, waiting until both are ready"""
+    def __init__(self, domain:str='domain.py', timeout:float=10.0):
+        self.domain = domain
+        self.timeout = timeout
+
+    def __enter__(self) -> tuple[int, int]:
+        self.ports = free_port(), free_port()
+        while self.ports[1] == self.ports[0]:
+            self.ports = self.ports[0], free_port()
+        self.procs = [subprocess.Popen([sys.executable, script, '--port', str(port)])
+            for script, port in zip(('hub.py', self.domain), self.ports)]
+        try:
+            for port, proc in zip(self.ports, self.procs):
+                wait_ready(f'http://localhost:{port}', self.timeout, proc)
+        except BaseException:
+            self.__exit__()
+            raise
+        return self.ports
+
+    def __exit__(self, *exc) -> None:
+        for proc in self.procs: proc.terminate()
+        for proc in self.procs: proc.wait()
@@ -1,5 +1,24 @@
-from aiohttp import web
+from aiohttp import web, ClientConnectionError, ClientError, ClientSession, ClientTimeout, TCPConnector, WSMsgType
+import asyncio
+import base64
+import collections
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import os
+import pickle
 import random
+import secrets
+import tempfile
+import time
+
+import codec
+import metrics
+import tracing
 
 routes = web.RouteTableDef()
 
@@ -10,18 +29,125 @@ routes = web.RouteTableDef()
 
 # How all the domains a situated relative to on another
 grid = {} # {(x,y): domain_id}
+exits = {} # {domain_id: {direction: neighbouring domain_id}}, derived from grid by link_map()
+regions = {} # {domain_id: text of the region command}, built on first use
+
+# Grid offsets of each journey direction, and the side a traveller arrives from
+headings = {'north':(0,1), 'south':(0,-1), 'east':(1,0), 'west':(-1,0)}
+opposite = {'north':'south', 'south':'north', 'east':'west', 'west':'east'}
 
 # Information about each domain
-domains = {} # {domain_id:{"url":url, "name":str, "description":str, "cell":[x,y], "loot":[item_id]}}
+domain_ids = [] # list(domains), kept for picking where new users start
+domains = {} # {domain_id:{"url":url, "name":str, "description":str, "cell":[x,y], "loot":[item_id], "batch":bool}}
 
 # All item templates
 templates = {} # {item_id:{"name":str, "description":str, "home":domain_id, "hosts":[domain_id], "depth":int}}
 
+# Read-only projections of templates sent in /arrive payloads, built on first use
+briefs = {} # {item_id:{"name":str, "description":str, "verb":{}, "id":item_id}}
+prize_briefs = {} # same as briefs, plus "depth"
+loot_briefs = {} # {domain_id:((item_id, prize brief),...)} for domains[domain_id]["loot"]
+
 # Centrally-tracked information about each user
-users = {} # id : {"in":domain_id, "open":[domain_id], "inventory":{item_id:location,...}}
+users = {} # id : {"in":domain_id, "open":[domain_id], "inventory":{item_id:location,...}, ...indexes}
+
+# Each user also carries indexes over "inventory", kept current by place_item().
+# Every index value is a dict used as an insertion-ordered set of item ids.
+#   "where":   {location key: {item_id}}  (see where_key)
+#   "named":   {item name: {item_id}}     carried items only
+#   "homed":   {home domain_id: {item_id}} carried items only
+#   "dropped": {domain_id: {item_id}}     items left in that domain
 
 # Global tracking of the different operation modes
 mode = "setup" # {"setup", "play", "locked"}
+mode_version = 0 # bumped by switch_mode() on every change
+mode_changed = None # asyncio.Future resolved by the next switch_mode(), made when a GET /mode first waits
+
+# Most seconds a GET /mode?wait=... may wait for the mode to change
+mode_wait_max = 60.0
+
+# Front-end files, read and gzipped once and kept in memory until they change on disk
+static = {} # {path: {"mtime":float, "body":bytes, "gzip":bytes, "etag":str, "modified":str}}
+
+# Most users one bulk POST /login may create
+bulk_login_max = 1000
+
+# Seconds a journey may take before the player gets a response; slower legs finish in the background
+journey_budget = 1.0
+
+# Seconds each outbound /depart or /arrive call may take
+leg_timeout = 2.5
+
+# Connections the hub may hold open to each domain, and how many to open when play starts
+domain_pool_size = 32
+domain_pool_warm = 4
+
+# Consecutive timeouts or connection failures before calls to a domain fail fast,
+# and seconds to fail fast before trying that domain again
+breaker_threshold = 5
+breaker_cooldown = 10.0
+
+# Each user's hub commands may come at most this fast, by command class: {class: (per second, burst)}.
+# Every command counts against "command"; those that call out to domains also against "travel".
+rate_limits = {'command':(10.0, 20), 'travel':(1.0, 5)}
+buckets = {} # {user_id: {class: TokenBucket}}
+
+# Journeys whose outbound legs outlived journey_budget
+pending = {} # {user_id: asyncio.Task}
+
+# Every user ranked by total points, kept current by apply(); see Leaderboard
+leaderboard = None # Leaderboard, made below once its class is defined
+
+# Open /ws connections, told whenever the mode changes
+sockets = set() # {web.WebSocketResponse}
+
+# Players' open /events streams, each with a queue of events not yet sent
+listeners = {} # {user_id: {asyncio.Queue: None}}
+
+# Events a stream may fall behind by before its oldest are dropped, and seconds between keep-alive comments
+event_buffer = 64
+event_keepalive = 15.0
+
+# Hub commands users can send to /command, registered with @command
+commands = {} # {name: Command}
+
+# Write-ahead log and snapshots of the state above, if the hub was started with --state
+journal = None # Journal
+
+# Where to save the world when play starts, for a later --world, if the hub was started with --save-world
+world_out = None
+
+# Logged changes between automatic snapshots
+snapshot_every = 100_000
+
+# Users idle this many seconds, or the least recently active beyond max_resident (if not 0),
+# are moved from users to idle_store, checked every idle_sweep_every seconds; only with --state,
+# --idle-ttl or --max-resident, as without an idle_store nobody is evicted
+idle_ttl = 3600.0
+max_resident = 0
+idle_sweep_every = 5.0
+idle_store = None # IdleStore, once configure() opens one
+spill = None # tempfile.TemporaryDirectory holding idle_store when there is no --state
+last_seen = collections.OrderedDict() # {user_id: time.monotonic()} of users in memory, least recently active first
+active = collections.Counter() # {user_id: hub commands being run}; such users are not evicted
+
+# In a multi-process hub, this process owns the users whose id % worker_count == worker_index
+worker_index = 0
+worker_count = 1
+
+# The id the next new user gets; it only moves forward, in steps of worker_count
+next_uid = 0
+
+# Key signing session tokens; each domain verifies its own tokens with domain_key(domain_id)
+token_key = secrets.token_bytes(32)
+
+# Seconds a session token stays valid
+token_ttl = 12*60*60
+
+# Secrets made ahead of time so logins don't wait on the random number generator
+secret_pool = collections.deque()
+secret_pool_size = 4096
+secrets_wanted = None # asyncio.Event, set when refill_secrets() should top up the pool
 
 
 
@@ -39,7 +165,9 @@ item_verbs = {
     'eat':"The {0} is hard and has basically no flavor, but you force it down anyway.\n\nMoments later you feel a strange glow suffuse your body, starting from your belly and concentrating in your hand. You open you hand to see what the glow is like and inside you see the same {0}, as good as new.\n\nThe glow is gone now, but you have conflicted feelings. You feel foolish to have even tried to eat the {0}, but also morbidly curious if it would do the same thing if you ate it again...",
 }
 others_items = []
-domains_prizes = {}
+
+# What journeying out of a lone domain awards, compiled by compile_awards() at play start
+awards = {} # {(domain_id, domstate): ((prize item_id,...), item_id that advances domstate)}
 
 
 ###################################
@@ -47,21 +175,112 @@ domains_prizes = {}
 
 
 def make_secret(secure=False, nbytes=12):
-    """Creates a random string"""
-    if secure:
-        import secrets
-        return secrets.token_urlsafe(nbytes)
+    """Creates a random string; all secrets are now from the secrets module, so secure is ignored"""
+    if nbytes == 12 and secret_pool:
+        if len(secret_pool) < secret_pool_size//2 and secrets_wanted: secrets_wanted.set()
+        return secret_pool.popleft()
+    return secrets.token_urlsafe(nbytes)
+
+async def refill_secrets() -> None:
+    """Background task keeping secret_pool stocked with 12-byte secrets"""
+    global secrets_wanted
+    secrets_wanted = asyncio.Event()
+    while True:
+        while len(secret_pool) < secret_pool_size:
+            block = base64.urlsafe_b64encode(secrets.token_bytes(12*256)).decode()
+            secret_pool.extend(block[i:i+16] for i in range(0, len(block), 16))
+            await asyncio.sleep(0)
+        secrets_wanted.clear()
+        await secrets_wanted.wait()
+
+def allocate_uid() -> int:
+    """Reserves the next user id this process owns"""
+    global next_uid
+    uid = next_uid
+    next_uid += worker_count
+    return uid
+
+
+class frozendict(dict):
+    """A dict that refuses modification, so cached projections can be shared between payloads"""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('frozendict is read-only')
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+def project(tid:int, keys:tuple) -> frozendict:
+    """Builds the read-only /arrive view of a template"""
+    t = templates[tid]
+    view = {k:v for k,v in t.items() if k in keys}
+    if 'verb' in view: view['verb'] = frozendict(view['verb'])
+    view['id'] = tid
+    return frozendict(view)
+
+def brief(tid:int) -> frozendict:
+    """The cached owned/carried/dropped projection of a template"""
+    view = briefs.get(tid)
+    if view is None:
+        view = briefs[tid] = project(tid, ('name','description','verb'))
+    return view
+
+def prize_brief(tid:int) -> frozendict:
+    """The cached prize projection of a template"""
+    view = prize_briefs.get(tid)
+    if view is None:
+        view = prize_briefs[tid] = project(tid, ('name','description','verb','depth'))
+    return view
+
+def where_key(loc) -> object:
+    """Hashable index key for an inventory location"""
+    if loc == 'inventory' or not isinstance(loc[1], (list, dict)):
+        return loc
+    return (loc[0], json.dumps(loc[1], sort_keys=True))
+
+def place_item(me:dict, tid:int, loc) -> None:
+    """Moves an item to loc in a user's inventory, keeping its indexes current"""
+    t = templates[tid]
+    old = me['inventory'].get(tid)
+    if old is not None:
+        me['where'][where_key(old)].pop(tid, None)
+        if old == 'inventory':
+            me['named'][t['name']].pop(tid, None)
+            me['homed'][t['home']].pop(tid, None)
+        else:
+            me['dropped'][old[0]].pop(tid, None)
+    me['inventory'][tid] = loc
+    me['where'].setdefault(where_key(loc), {})[tid] = None
+    if loc == 'inventory':
+        me['named'].setdefault(t['name'], {})[tid] = None
+        me['homed'].setdefault(t['home'], {})[tid] = None
     else:
-        import string
-        alphabet = string.ascii_letters + string.digits + '-_'
-        return ''.join(random.choice(alphabet) for _ in range(nbytes*8//6))
+        me['dropped'].setdefault(loc[0], {})[tid] = None
 
 
 def make_map():
-    """Puts each domain in a random location on a grid"""
-    # For this practice hub, only a single domain is supported
+    """Puts each domain in a random location on a grid
 
-    # Instead, pick a randomized set of items to host
+    Domains are placed one at a time on a random empty cell next to one already
+    placed, so every domain can be reached from every other by journeying.
+    """
+    grid.clear()
+    frontier = [(0,0)] # empty cells next to the map, in no order
+    seen = {(0,0)}
+    order = list(domains)
+    random.shuffle(order)
+    for did in order:
+        i = random.randrange(len(frontier))
+        frontier[i], frontier[-1] = frontier[-1], frontier[i]
+        x,y = cell = frontier.pop()
+        grid[cell] = did
+        domains[did]['cell'] = [x,y]
+        for dx,dy in headings.values():
+            if (x+dx,y+dy) not in seen:
+                seen.add((x+dx,y+dy))
+                frontier.append((x+dx,y+dy))
+    link_map()
+
+    if len(domains) > 1 or others_items: return
+
+    # A lone domain has no neighbours, so pick a randomized "outside world" set of items to host instead
     verbs = list(item_verbs.keys())
     random.shuffle(verbs)
     random.shuffle(item_names)
@@ -82,53 +301,263 @@ def make_map():
         'depth': random.randrange(3),
         'home':-1,
     })
-    for tid in templates:
-        item = templates[tid]
-        if 'depth' in item:
-            domains_prizes.setdefault(item['home'],{}).setdefault(item['depth'],[]).append(tid)
 
-    return
+def link_map():
+    """Rebuilds the neighbour table from grid"""
+    exits.clear()
+    regions.clear()
+    for (x,y),did in grid.items():
+        exits[did] = {way:grid[x+dx,y+dy] for way,(dx,dy) in headings.items() if (x+dx,y+dy) in grid}
 
 def assign_loot():
     """Distributes items with depth to other domains"""
-    # For this MP, only a single domain is supported, so this picks a random "outside world" scenario instead
-    global live_domain
-    
-    lootid = random.randrange(1000)
-    while lootid in templates: lootid += 1
-    hostid = next(iter(domains))
-    domains[hostid]['loot'] = []
-    for i in range(len(others_items)):
-        templates[lootid+i] = others_items[i]
-        others_items[i]['id'] = lootid+i
-        templates[lootid+i]['hosts'] = [hostid]
-        domains[hostid]['loot'].append(lootid+i)
+    for did in domains:
+        domains[did]['loot'] = []
+    if len(domains) == 1:
+        # The lone domain hosts the "outside world" items make_map() picked
+        lootid = random.randrange(1000)
+        while any(lootid+i in templates for i in range(len(others_items))): lootid += 1
+        hostid = next(iter(domains))
+        for i in range(len(others_items)):
+            templates[lootid+i] = others_items[i]
+            others_items[i]['id'] = lootid+i
+            templates[lootid+i]['hosts'] = [hostid]
+            domains[hostid]['loot'].append(lootid+i)
+    else:
+        for tid,item in templates.items():
+            if 'depth' not in item: continue
+            hostid = item['home']
+            while hostid == item['home']:
+                hostid = domain_ids[random.randrange(len(domain_ids))]
+            item['hosts'] = [hostid]
+            domains[hostid]['loot'].append(tid)
+    for did in domains:
+        loot_briefs[did] = tuple((tid, prize_brief(tid)) for tid in domains[did]['loot'])
+    compile_awards()
+
+def compile_awards():
+    """Builds the journey award table for a lone domain from templates and others_items"""
+    awards.clear()
+    if not others_items: return
+    prizes = {}
+    for tid,item in templates.items():
+        if 'depth' in item and item['home'] in domains:
+            prizes.setdefault((item['home'], item['depth']), []).append(tid)
+    for did in domains:
+        for ds in range(3):
+            awards[did, ds] = (tuple(prizes.get((did, ds), ())), others_items[ds]['id'])
+
+
+class DomainDegraded(Exception):
+    """Raised instead of calling a domain whose circuit breaker is open"""
+
+class DomainLink:
+    """The hub's connection pool and circuit breaker for one domain"""
+    def __init__(self, did:int, url:str, kind:str=codec.JSON):
+        self.url = url
+        self.kind = kind # Content-Type for bodies sent to this domain, from codec.pick()
+        self.failures = 0 # consecutive timeouts and connection failures
+        self.retry_at = 0.0 # while the breaker is open, time.monotonic() of the next attempt
+        self.probing = False # whether the one trial call allowed once retry_at passes is under way
+        self.session = ClientSession(
+            connector=TCPConnector(limit=domain_pool_size, keepalive_timeout=60),
+            timeout=ClientTimeout(total=3),
+            trace_configs=[metrics.client_timing('hub_domain_call_seconds', domain=did), tracing.client_trace()])
+
+    @property
+    def degraded(self) -> bool:
+        return self.failures >= breaker_threshold
+
+    @contextlib.asynccontextmanager
+    async def post(self, path:str, json=None, **kwargs):
+        """Like ClientSession.post, but failing fast while the domain is degraded and sending json in the negotiated type
+
+        Once the cooldown has passed, a single call is let through as a trial;
+        the others keep failing fast until it succeeds and closes the breaker.
+        """
+        trial = self.degraded
+        if trial:
+            if self.probing or time.monotonic() < self.retry_at:
+                raise DomainDegraded(self.url+' is not responding')
+            self.probing = True
+        if json is not None:
+            kwargs['data'] = codec.encode(json, self.kind)
+            kwargs['headers'] = codec.headers(self.kind)
+        try:
+            async with self.session.post(self.url+path, **kwargs) as resp:
+                self.failures = 0
+                yield resp
+        except (asyncio.TimeoutError, ClientConnectionError):
+            self.failures += 1
+            if self.degraded:
+                self.retry_at = time.monotonic() + breaker_cooldown
+            raise
+        finally:
+            if trial: self.probing = False
+
+    async def warm(self, count:int) -> None:
+        """Opens count keep-alive connections ahead of the first players"""
+        async def touch():
+            try:
+                async with self.session.get(self.url+'/healthz') as resp:
+                    await resp.read()
+            except Exception as ex:
+                print('ERROR: could not warm up', self.url, repr(ex))
+        await asyncio.gather(*(touch() for _ in range(count)))
+
+    async def close(self) -> None:
+        await self.session.close()
+
+async def open_links(app:web.Application) -> None:
+    """Creates and warms up a DomainLink for each registered domain"""
+    for did in domains:
+        if did not in app.links:
+            app.links[did] = DomainLink(did, domains[did]['url'], codec.pick(domains[did].get('codecs', ())))
+    await asyncio.gather(*(link.warm(min(domain_pool_warm, domain_pool_size)) for link in app.links.values()))
+
+
+def domain_key(did:int) -> bytes:
+    """The key a domain is given at /register to verify the session tokens issued for it"""
+    return hmac.digest(token_key, b'domain %d' % did, hashlib.sha256)
+
+def sign(uid:int, key:bytes) -> str:
+    """Issues a session token for a user: "user.expiry.mac", with an HMAC-SHA256 mac"""
+    payload = f'{uid}.{int(time.time())+token_ttl}'
+    mac = hmac.digest(key, payload.encode(), hashlib.sha256)
+    return payload+'.'+base64.urlsafe_b64encode(mac).rstrip(b'=').decode()
+
+def verify(token, key:bytes) -> int | None:
+    """The user a session token was signed for, or None if it is forged, malformed or expired"""
+    try:
+        uid, expiry, mac = token.split('.')
+        good = hmac.digest(key, f'{uid}.{expiry}'.encode(), hashlib.sha256)
+        if not hmac.compare_digest(base64.urlsafe_b64encode(good).rstrip(b'=').decode(), mac): return None
+        if int(expiry) < time.time(): return None
+        return int(uid)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def total_points(uid:int) -> float:
+    """A user's score across all domains, as shown by the score command"""
+    return points_of(users[uid])
+
+def points_of(me:dict) -> float:
+    return sum(me['score'].values()) + round(me['domstate']/2,2)
+
+class Leaderboard:
+    """Users ranked by total points, at a resolution of 0.001 points
+
+    A Fenwick tree counts users at each point value, so updates, ranks and
+    percentiles take O(log n) time and the top k take O(k log n).
+    """
+    def __init__(self, size:int=4096):
+        self.tree = [0]*(size+1) # Fenwick tree over point values 0..size-1, 1-indexed
+        self.points = {} # {user_id: point value}
+        self.holders = {} # {point value: {user_id: None}}
+
+    def clear(self) -> None:
+        self.__init__()
+
+    def update(self, uid:int, total:float) -> None:
+        key = round(total*1000)
+        old = self.points.get(uid)
+        if old == key: return
+        if old is not None:
+            self.add(old, -1)
+            del self.holders[old][uid]
+            if not self.holders[old]: del self.holders[old]
+        while key >= len(self.tree)-1:
+            self.grow()
+        self.add(key, 1)
+        self.holders.setdefault(key, {})[uid] = None
+        self.points[uid] = key
+
+    def add(self, key:int, delta:int) -> None:
+        i = key+1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def grow(self) -> None:
+        """Doubles the range of point values, rebuilding the tree in linear time"""
+        tree = [0]*(2*(len(self.tree)-1)+1)
+        for key,group in self.holders.items(): tree[key+1] = len(group)
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree): tree[j] += tree[i]
+        self.tree = tree
+
+    def at_most(self, key:int) -> int:
+        """How many users have a point value of key or less"""
+        i, n = min(key+1, len(self.tree)-1), 0
+        while i > 0:
+            n += self.tree[i]
+            i -= i & -i
+        return n
+
+    def kth(self, k:int) -> int:
+        """The point value of the k-th lowest-scoring user, counting from 1"""
+        i, step = 0, 1 << (len(self.tree)-1).bit_length()
+        while step:
+            if i+step < len(self.tree) and self.tree[i+step] < k:
+                i += step
+                k -= self.tree[i]
+            step >>= 1
+        return i
+
+    def above(self, total:float) -> int:
+        """How many users have more than total points"""
+        return len(self.points) - self.at_most(round(total*1000))
+
+    def rank(self, uid:int) -> int:
+        return len(self.points) - self.at_most(self.points[uid]) + 1
+
+    def percentile(self, uid:int) -> float:
+        """Share of users with no more points than uid, as a percentage"""
+        return 100 * self.at_most(self.points[uid]) / len(self.points)
+
+    def top(self, k:int) -> list[dict]:
+        ans, seen = [], 0
+        while len(ans) < k and seen < len(self.points):
+            key = self.kth(len(self.points) - seen)
+            for uid in self.holders[key]:
+                if len(ans) == k: break
+                ans.append({'user':uid, 'points':key/1000, 'rank':seen+1})
+            seen += len(self.holders[key])
+        return ans
+
+leaderboard = Leaderboard()
 
 
 def checkuid(data : dict) -> web.Response | int:
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Only available during play'})
+        return codec.json_response(status=409, data={'error':'Only available during play'})
+    if 'token' in data:
+        uid = verify(data['token'], token_key)
+        if uid is None or data.get('user', uid) != uid or not resident(uid):
+            return codec.json_response(status=403, data={'error':'Invalid or expired token'})
+        return uid
     for need in 'user','secret':
         if need not in data:
-            return web.json_response(status=400, data={'error':'Request must contain '+need})
+            return codec.json_response(status=400, data={'error':'Request must contain '+need})
     uid = data['user']
-    if uid not in users:
-        return web.json_response(status=403, data={'error':f'User {uid} not known'})
+    if not resident(uid):
+        return codec.json_response(status=403, data={'error':f'User {uid} not known'})
     if users[uid]['secret'] != data['secret']:
-        return web.json_response(status=403, data={'error':f'Invalid secret'})
+        return codec.json_response(status=403, data={'error':f'Invalid secret'})
     return uid
 
 def checkdid(data : dict) -> web.Response | int:
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Only available during play'})
+        return codec.json_response(status=409, data={'error':'Only available during play'})
     for need in 'domain','secret':
         if need not in data:
-            return web.json_response(status=400, data={'error':'Request must contain '+need})
+            return codec.json_response(status=400, data={'error':'Request must contain '+need})
     did = data['domain']
     if did not in domains:
-        return web.json_response(status=403, data={'error':f'Domain {did} not known'})
+        return codec.json_response(status=403, data={'error':f'Domain {did} not known'})
     if domains[did]['secret'] != data['secret']:
-        return web.json_response(status=403, data={'error':f'Invalid secret'})
+        return codec.json_response(status=403, data={'error':f'Invalid secret'})
     return did
     
 
@@ -139,37 +568,122 @@ def checkdid(data : dict) -> web.Response | int:
 @routes.get("/")
 async def web_interface(req : web.Request) -> web.StreamResponse:
     """Display web front-end"""
-    return web.FileResponse(path="tba.html")
+    page = static_file('tba.html')
+    zipped = 'gzip' in req.headers.get('Accept-Encoding', '')
+    etag = page['etag'][:-1]+'-gzip"' if zipped else page['etag']
+    headers = {'ETag':etag, 'Last-Modified':page['modified'], 'Cache-Control':'no-cache', 'Vary':'Accept-Encoding'}
+    if not_modified(req, (page['etag'], page['etag'][:-1]+'-gzip"'), page['mtime']):
+        return web.Response(status=304, headers=headers)
+    if zipped:
+        headers['Content-Encoding'] = 'gzip'
+        return web.Response(body=page['gzip'], content_type='text/html', charset='utf-8', headers=headers)
+    return web.Response(body=page['body'], content_type='text/html', charset='utf-8', headers=headers)
+
+def static_file(path:str) -> dict:
+    """A front-end file from the static cache, reloaded if it changed on disk"""
+    mtime = os.stat(path).st_mtime
+    found = static.get(path)
+    if found is None or found['mtime'] != mtime:
+        with open(path, 'rb') as f: body = f.read()
+        found = static[path] = {'mtime':mtime, 'body':body, 'gzip':gzip.compress(body, 9),
+            'etag':'"'+hashlib.sha256(body).hexdigest()[:16]+'"', 'modified':email.utils.formatdate(mtime, usegmt=True)}
+    return found
+
+def not_modified(req:web.Request, etags:tuple[str], mtime:float|None=None) -> bool:
+    """Whether a conditional GET's If-None-Match or If-Modified-Since says the client's copy is current"""
+    match = req.headers.get('If-None-Match')
+    if match is not None:
+        return match.strip() == '*' or any(tag.strip().removeprefix('W/') in etags for tag in match.split(','))
+    since = req.if_modified_since
+    return mtime is not None and since is not None and since.timestamp() >= int(mtime)
+
+@routes.get("/healthz")
+async def healthz(req : web.Request) -> web.Response:
+    """Liveness probe: answers whenever the hub is accepting requests"""
+    return web.Response(text='ok')
+
+@routes.get("/readyz")
+async def readyz(req : web.Request) -> web.Response:
+    """Readiness probe: 503 while the hub is switching modes, otherwise what it is ready for"""
+    ready = mode != 'locked'
+    return codec.json_response(status=200 if ready else 503,
+        data={'ready':ready, 'mode':mode, 'domains':len(domains), 'users':len(users)})
 
 @routes.get("/mode")
 async def get_mode(req : web.Request) -> web.Response:
-    """Get the mode of the server (play or setup)"""
-    return web.Response(text=mode)
+    """Get the mode of the server (play or setup)
+
+    The X-Mode-Version header (also the ETag) names the answer. A request
+    naming the current version, with ?version= or If-None-Match, gets a 304;
+    with ?wait=seconds as well, it first waits that long for the mode to change.
+    """
+    global mode_changed
+    def current():
+        tag = mode_tag()
+        return req.query.get('version') == tag or not_modified(req, ('"'+tag+'"',))
+    if 'wait' in req.query and current():
+        try: wait = float(req.query['wait'])
+        except ValueError: wait = -1
+        if not math.isfinite(wait) or wait < 0:
+            return codec.json_response(status=400, data={"error":"wait must be a non-negative number of seconds"})
+        wait = min(wait, mode_wait_max)
+        if mode_changed is None:
+            mode_changed = asyncio.get_running_loop().create_future()
+        try: await asyncio.wait_for(asyncio.shield(mode_changed), wait)
+        except asyncio.TimeoutError: pass
+    tag = mode_tag()
+    headers = {'ETag':'"'+tag+'"', 'X-Mode-Version':tag, 'Cache-Control':'no-cache'}
+    if current():
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=mode, headers=headers)
+
+def mode_tag() -> str:
+    return f'{mode_version}-{mode}'
+
+def switch_mode(newmode:str) -> None:
+    """Changes mode and wakes GET /mode requests waiting for a change"""
+    global mode, mode_version, mode_changed
+    mode = newmode
+    mode_version += 1
+    if mode_changed is not None:
+        if not mode_changed.done(): mode_changed.set_result(None)
+        mode_changed = None
 
 @routes.post("/mode")
 async def set_mode(req : web.Request) -> web.Response:
     """Change the mode of the server"""
-    global mode
     newmode = await req.text()
     if newmode == mode: return web.Response(text="Already in "+newmode+" mode")
     elif mode == 'locked': return web.Response(status=409, text="Error: request sent midway through handling another request.")
     elif newmode == 'setup':
         return web.Response(status=403, text="The demo server cannot be put into setup mode.")
-        mode = 'setup'
+        switch_mode('setup')
         users.clear()
+        leaderboard.clear()
         grid.clear()
+        exits.clear()
+        regions.clear()
         domains.clear()
+        domain_ids.clear()
         templates.clear()
+        briefs.clear()
+        prize_briefs.clear()
+        loot_briefs.clear()
     elif newmode == 'play':
         if len(domains) == 0:
             return web.Response(status=409, text="Must register at least one domain before entering play mode.")
-        mode = 'locked'
+        switch_mode('locked')
         make_map()
         assign_loot()
-        mode = 'play'
+        if world_out: save_world(world_out)
+        await open_links(req.app)
+        if journal is not None: await journal.idle()
+        switch_mode('play')
+        if journal is not None: journal.snapshot()
     else:
         return web.Response(status=400, text="Unknown mode "+repr(newmode))
     
+    await announce({'mode':mode})
     return web.Response(text="Now in "+mode+" mode")
 
 @routes.post("/domain")
@@ -182,7 +696,7 @@ async def notify_domain(req : web.Request) -> web.Response:
         if any(d['url'] == data for d in domains.values()):
             return web.Response(text="That domain server has already been registered.")
         async with req.app.client.post(data+'/newhub', data=whoami) as resp:
-            spot = await resp.json()
+            spot = await codec.read(resp)
             if 'error' in spot:
                 return web.Response(text="Domain server returned an error message:<pre>"+spot['error']+"</pre>")
             else:
@@ -190,10 +704,20 @@ async def notify_domain(req : web.Request) -> web.Response:
     except BaseException as ex:
         return web.Response(status=500, text="Domain registration failed with error:<pre>"+repr(ex)+"</pre>")
     
+@routes.get("/domains")
+async def domain_status(req : web.Request) -> web.Response:
+    """Reports which domains the hub can currently reach"""
+    return codec.json_response(data={did:{
+        'name':domains[did]['name'],
+        'url':link.url,
+        'degraded':link.degraded,
+        'failures':link.failures,
+    } for did,link in req.app.links.items()})
+
 @routes.post("/newhub")
 async def notify_domain(req : web.Request) -> web.Response:
     """Placeholder to give more useful error messages for on common error"""
-    return web.json_response(status=400, data={
+    return codec.json_response(status=400, data={
         'error': whoami+' is the URL of the hub server, not a domain server.'
     })
 
@@ -201,41 +725,221 @@ async def notify_domain(req : web.Request) -> web.Response:
 async def login(req : web.Request) -> web.Response:
     """User log-in"""
     if mode != 'play':
-        return web.json_response(status=409, data={'error':'Players cannot log in during setup'})
+        return codec.json_response(status=409, data={'error':'Players cannot log in during setup'})
+    uid = new_user()
+    await arrive(uid, users[uid]['in'], req.app, 'login')
+    return codec.json_response(data=welcome(uid))
+
+@routes.post("/login")
+async def bulk_login(req : web.Request) -> web.Response:
+    """Log in many users at once
+    
+    { "count": number of users to create, at most bulk_login_max
+    }
+    
+    Each domain is sent a single /arrive_batch for all of its new users.
+    Return is a list with what GET /login would have returned for each user,
+    plus "arrived": false for any user their domain did not accept.
+    """
+    if mode != 'play':
+        return codec.json_response(status=409, data={'error':'Players cannot log in during setup'})
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
+    count = data.get('count') if isinstance(data, dict) else None
+    if not isinstance(count, int) or isinstance(count, bool) or not 0 < count <= bulk_login_max:
+        return codec.json_response(status=400, data={"error":f"Count between 1 and {bulk_login_max} required"})
+    uids = [new_user() for _ in range(count)]
+    batches = {}
+    for uid in uids:
+        batches.setdefault(users[uid]['in'], []).append(uid)
+    arrived = await asyncio.gather(*(arrive_batch(batch, did, req.app, 'login') for did,batch in batches.items()))
+    failed = {uid for batch,oks in zip(batches.values(), arrived) for uid,ok in zip(batch, oks) if not ok}
+    return codec.json_response(data=[welcome(uid) | ({'arrived':False} if uid in failed else {}) for uid in uids])
+
+def new_user() -> int:
+    """Creates a user in a random domain and returns their id"""
     data = {}
     data['secret'] = make_secret()
-    data['in'] = random.choice(tuple(domains))
+    data['in'] = random.choice(domain_ids)
     data['open'] = [data['in']]
     data['inventory'] = {}
     data['domstate'] = 0
     data['score'] = {}
     data['hashad'] = set() # items ever in inventory
-    uid = len(users)
-    users[uid] = data
-    await arrive(uid, data['in'], req.app, 'login')
-    return web.json_response(data={'id':uid,'secret':data['secret'],
-        'domain':{k:v for k,v in domains[data['in']].items() if k in ('url','name','description')}})
+    data['where'] = {}
+    data['named'] = {}
+    data['homed'] = {}
+    data['dropped'] = {}
+    uid = allocate_uid()
+    change('user', uid, data)
+    return uid
+
+def welcome(uid:int) -> dict:
+    """What a user is told when they log in"""
+    me = users[uid]
+    return {'id':uid,'secret':me['secret'],'token':sign(uid, token_key),
+        'domain':{k:v for k,v in domains[me['in']].items() if k in ('url','name','description')}
+            | {'token':sign(uid, domain_key(me['in']))}}
+
+@routes.post("/token")
+async def domain_token(req : web.Request) -> web.Response:
+    """Issues a session token for the domain a user is currently in
+    
+    { "user": user id
+    , "secret" or "token": the user's secret or hub session token
+    }
+    """
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
+    uid = checkuid(data)
+    if isinstance(uid, web.Response): return uid
+    did = users[uid]['in']
+    return codec.json_response(data={'domain':did, 'token':sign(uid, domain_key(did)),
+        'url':domains[did]['url'], 'name':domains[did]['name']})
 
 
 @routes.post("/command")
 async def handle_command(req : web.Request) -> web.Response:
     """Handle hub-server commands"""
-    try: data = await req.json()
-    except: return web.json_response(status=400, text="JSON data required")
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, text="JSON data required")
+    return await run_command(data, req.app)
+
+async def run_command(data, app:web.Application) -> web.Response:
+    """Runs a /command request body"""
+    if not isinstance(data, dict): return codec.json_response(status=400, text="JSON object required")
     uid = checkuid(data)
     if isinstance(uid, web.Response): return uid
-    if 'command' not in data: return web.json_response(status=400, text="Command expected")
+    if 'command' not in data: return codec.json_response(status=400, text="Command expected")
     cmd = data['command']
-    if not isinstance(cmd, list): return web.json_response(status=400, text="Command should be a list")
-    if not all(isinstance(word, str) for word in cmd): return web.json_response(status=400, text="Command should be a list of strings")
+    if not isinstance(cmd, list): return codec.json_response(status=400, text="Command should be a list")
+    if not all(isinstance(word, str) for word in cmd): return codec.json_response(status=400, text="Command should be a list of strings")
     
-    if cmd[0] == 'region': return await region(uid, cmd[1:])
-    if cmd[0] == 'journey': return await journey(uid, cmd[1:], req.app)
-    if cmd[0] == 'inventory': return await inventory(uid, cmd[1:])
-    if cmd[0] == 'score': return await score(uid, cmd[1:])
-    if cmd[0] == 'drop': return await drop(uid, cmd[1:], req.app)
+    handler = commands.get(cmd[0]) if cmd else None
+    wait = throttle(uid, handler.limits if handler is not None else ('command',))
+    if wait:
+        metrics.count('hub_commands_throttled_total', command=handler.name if handler is not None else 'unknown')
+        return codec.json_response(status=429, data={"error":"Too many commands; try again in a moment", "retry_after":round(wait, 3)},
+            headers={'Retry-After':str(math.ceil(wait))})
+    if handler is None:
+        return web.Response(text="I don't know how to do that")
+    active[uid] += 1 # the handler holds users[uid] across awaits
+    try:
+        return await handler(uid, cmd[1:], app)
+    finally:
+        active[uid] -= 1
+        if not active[uid]: del active[uid]
+
+@routes.get("/ws")
+async def websocket(req : web.Request) -> web.WebSocketResponse:
+    """A persistent channel for the web front-end's play-mode commands
     
-    return web.Response(text="I don't know how to do that")
+    Each message sent is {"id": any, "to": "hub" or "domain", "body": a /command body}.
+    Each is answered in turn with {"id": the same, "status": HTTP status, "text": response text}.
+    Commands for a domain go to the one the user is in, over the hub's pooled connections.
+    Whenever the mode changes the hub also sends {"mode": new mode}.
+    """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(req)
+    sockets.add(ws)
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT: continue
+            try: data = codec.loads(msg.data)
+            except ValueError: data = None
+            await ws.send_str(codec.dumps(await deliver(data, req.app)).decode())
+    finally:
+        sockets.discard(ws)
+    return ws
+
+tracing.quiet.add('/ws') # each message is traced on its own instead
+
+async def deliver(data, app:web.Application) -> dict:
+    """Answers one /ws message"""
+    if not isinstance(data, dict) or data.get('to') not in ('hub','domain') or not isinstance(data.get('body'), dict):
+        return {'id':data.get('id') if isinstance(data, dict) else None, 'status':400,
+            'text':'Messages should be {"id":..., "to":"hub" or "domain", "body":{...}}'}
+    to, body = data['to'], data['body']
+    start = time.perf_counter()
+    with tracing.root('WS '+to):
+        try:
+            if to == 'hub':
+                resp = await run_command(body, app)
+                status, text = resp.status, resp.text
+            else:
+                status, text = await forward(body, app)
+        except Exception as ex: # answered like an HTTP 500, keeping the socket open
+            print('ERROR: /ws message', data.get('id'), 'failed', repr(ex))
+            status, text = 500, 'Internal Server Error'
+    metrics.histogram('hub_ws_message_seconds', to=to).observe(time.perf_counter() - start)
+    return {'id':data.get('id'), 'status':status, 'text':text}
+
+async def forward(body:dict, app:web.Application) -> tuple[int, str]:
+    """Passes a /command body to the domain its user is in; returns the domain's status and text"""
+    uid = body.get('user')
+    if mode != 'play' or not isinstance(uid, int) or not resident(uid):
+        return 403, 'Unknown user'
+    did = users[uid]['in']
+    try:
+        async with app.links[did].post('/command', json=body) as resp:
+            return resp.status, await resp.text()
+    except DomainDegraded:
+        return 503, domains[did]['name']+' is not responding'
+    except (asyncio.TimeoutError, ClientConnectionError) as ex:
+        return 502, 'Could not reach '+domains[did]['name']+': '+repr(ex)
+
+async def announce(event:dict) -> None:
+    """Sends a mode change to every open /ws connection and /events stream"""
+    for ws in list(sockets):
+        try: await ws.send_json(event)
+        except (ConnectionError, RuntimeError): sockets.discard(ws)
+    for uid in listeners:
+        publish(uid, 'mode', event)
+
+@routes.get("/events")
+async def events(req : web.Request) -> web.StreamResponse:
+    """A server-sent event stream of one player's score changes, item moves, failed journeys and mode changes
+    
+    Query parameters: user, and either token or secret, as for /command.
+    Events are "score" {domain, points, total}, "item" {item, name, at}, "mode" {mode},
+    and "journey" {domain, arrived, text} when a journey answered early turns out not to have arrived.
+    A player who falls more than event_buffer events behind loses the oldest.
+    """
+    try: data = {'user':int(req.query['user'])} | {k:req.query[k] for k in ('token','secret') if k in req.query}
+    except (KeyError, ValueError): return codec.json_response(status=400, data={"error":"Integer user required"})
+    uid = checkuid(data)
+    if isinstance(uid, web.Response): return uid
+    resp = web.StreamResponse(headers={'Content-Type':'text/event-stream', 'Cache-Control':'no-cache'})
+    await resp.prepare(req)
+    queue = asyncio.Queue(event_buffer)
+    listeners.setdefault(uid, {})[queue] = None
+    try:
+        while True:
+            try: kind, data = await asyncio.wait_for(queue.get(), event_keepalive)
+            except asyncio.TimeoutError:
+                await resp.write(b': keep-alive\n\n')
+                continue
+            await resp.write(b'event: '+kind.encode()+b'\ndata: '+codec.dumps(data)+b'\n\n')
+    except ConnectionError:
+        return resp
+    finally:
+        del listeners[uid][queue]
+        if not listeners[uid]: del listeners[uid]
+
+tracing.quiet.add('/events')
+
+def publish(uid:int, kind:str, data:dict) -> None:
+    """Queues an event on each of a player's /events streams, dropping the oldest from full queues"""
+    for queue in listeners.get(uid, ()):
+        if queue.full():
+            queue.get_nowait()
+            metrics.count('hub_events_dropped_total')
+        queue.put_nowait((kind, data))
+
+@routes.get("/commands")
+async def command_stats(req : web.Request) -> web.Response:
+    """Calls, errors and latency histograms for each hub command"""
+    return codec.json_response(data={name:c.stats() for name,c in commands.items()})
 
 
 
@@ -245,121 +949,311 @@ async def handle_command(req : web.Request) -> web.Response:
 ##################################
 ###  Section: command helpers  ###
 
-async def region(uid:int, rest:list[str]) -> web.Response:
+class TokenBucket:
+    """Allows bursts of up to burst calls, refilled at rate calls per second"""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def wait(self) -> float:
+        """Seconds until a call is allowed, after refilling; 0 if one is allowed now"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp)*self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens)/self.rate
+
+def throttle(uid:int, classes:tuple[str]) -> float:
+    """Takes a token from each of a user's buckets for classes, or returns seconds to wait if any is empty"""
+    mine = buckets.setdefault(uid, {})
+    wait = 0.0
+    for name in classes:
+        if name not in rate_limits: continue
+        bucket = mine.get(name)
+        if bucket is None:
+            bucket = mine[name] = TokenBucket(*rate_limits[name])
+        wait = max(wait, bucket.wait())
+    if wait: return wait
+    for name in classes:
+        if name in mine: mine[name].tokens -= 1
+    return 0.0
+
+class Command:
+    """A registered hub command, with its argument rules and call statistics"""
+    def __init__(self, name:str, handler, nargs:tuple, choices:tuple|None, usage:str|None, status:int, limits:tuple[str]):
+        self.name = name
+        self.handler = handler
+        self.limits = limits # rate_limits classes each call counts against
+        self.nargs = nargs # (fewest, most) words after the command; most may be None
+        self.choices = choices # allowed words, if the command takes exactly one
+        self.usage = usage # reply when the arguments are not allowed
+        self.status = status # status code of that reply
+        self.rejected = 0 # calls refused for their arguments
+        self.latency = metrics.histogram('hub_command_seconds', command=name)
+        self.errors = metrics.histogram('hub_command_error_seconds', command=name) # calls that raised or answered with an error status
+
+    def accepts(self, rest:list[str]) -> bool:
+        fewest, most = self.nargs
+        if len(rest) < fewest or (most is not None and len(rest) > most): return False
+        return self.choices is None or all(word in self.choices for word in rest)
+
+    async def __call__(self, uid:int, rest:list[str], app:web.Application) -> web.Response:
+        if not self.accepts(rest):
+            self.rejected += 1
+            return web.Response(text=self.usage or "I don't know how to do that", status=self.status)
+        start = time.perf_counter()
+        failed = True
+        try:
+            with tracing.span(self.name):
+                resp = await self.handler(uid, rest, app)
+            failed = resp.status >= 400
+            return resp
+        finally:
+            took = time.perf_counter() - start
+            self.latency.observe(took)
+            if failed: self.errors.observe(took)
+
+    def stats(self) -> dict:
+        return {'calls':self.latency.count, 'errors':self.errors.count, 'rejected':self.rejected,
+            'latency':self.latency.as_dict(), 'error_latency':self.errors.as_dict()}
+
+def command(name:str, nargs:tuple=(0,None), choices:tuple|None=None, usage:str|None=None, status:int=200, limits:tuple[str]=('command',)):
+    """Decorator registering a handler(uid, rest, app) as the hub command name"""
+    def register(handler):
+        commands[name] = Command(name, handler, nargs, choices, usage, status, limits)
+        return handler
+    return register
+
+
+@command('region')
+async def region(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Information about the current domain for the user"""
-    me = users[uid]
-    here = domains[me['in']]
-    return web.Response(text='You are in domain <strong>'+here['name']+'</strong>\n'+here['description']+'\n\nFor this MP, there is no detail available about other domains in the region.')
-
+    did = users[uid]['in']
+    text = regions.get(did)
+    if text is None:
+        text = regions[did] = describe_region(did)
+    return web.Response(text=text)
+
+def describe_region(did:int) -> str:
+    """The region command's text for a domain and its neighbours"""
+    here = domains[did]
+    lines = ['You are in domain <strong>'+here['name']+'</strong>', here['description'], '']
+    near = exits.get(did, {})
+    if not near:
+        lines.append('There are no other domains in this region.')
+    for way in headings:
+        if way in near:
+            lines.append('To the '+way+' lies <strong>'+domains[near[way]]['name']+'</strong>.')
+    return '\n'.join(lines)
+
+@command('journey', nargs=(1,1), choices=('north','south','east','west'),
+    usage='I only know how to journey in cardinal directions', status=403, limits=('command','travel'))
 async def journey(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """User-initiated move between domains"""
-    if len(rest) != 1 or rest[0] not in ('north','south','east','west'):
-        return web.Response(text='I only know how to journey in cardinal directions', status=403)
-
     me = users[uid]
-    here = domains[me['in']]
-    src = {'north':'south','south':'north','east':'west','west':'east'}.get(rest[0],'direct')
-
-    try:
-        async with app.client.post(here['url']+'/depart', json={
-            'secret':here['secret'],
-            'user':uid,
-        }) as resp:
-            if not resp.ok:
-                print("/depart returned a failing status code", resp.status)
-    except BaseException as ex:
-        print("/depart failed", ex)
-
-
-    msg = ['You travel in other domains for a time.']
-    used = []
-    for ds in range(3):
-        if me['domstate'] == ds:
-            for prize in domains_prizes.get(me['in'],{}).get(ds,[]):
+    here = me['in']
+    src = opposite.get(rest[0],'direct')
+    dest = exits.get(here, {}).get(rest[0])
+
+    if dest is not None:
+        change('move', uid, dest)
+        msg = ['You journey '+rest[0]+' to domain <strong>'+domains[dest]['name']+'</strong>', domains[dest]['description']]
+    elif not others_items:
+        return web.Response(text='There is no domain to the '+rest[0]+' of here.')
+    else:
+        dest = here
+        msg = ['You travel in other domains for a time.']
+        ds = me['domstate']
+        while (here, ds) in awards:
+            prizes, key = awards[here, ds]
+            for prize in prizes:
                 if prize not in me['hashad']:
-                    me['inventory'][prize] = 'inventory'
-                    me['hashad'].add(prize)
+                    change('item', uid, prize, 'inventory')
                     msg.append('You find a '+templates[prize]['name'])
-            if me['inventory'].get(others_items[ds]['id']) == 'inventory':
-                me['domstate'] = ds+1
-                msg.append('You use your '+others_items[ds]['name']+' to bypass an obstacle.')
-    if len(msg) == 1: msg.append('Finding nothing new, you return to this domain.')
-    else: msg.append('You then return to this domain.')
-
-    await arrive(uid, me['in'], app, src)
+            if me['inventory'].get(key) != 'inventory': break
+            change('domstate', uid, ds+1)
+            msg.append('You use your '+templates[key]['name']+' to bypass an obstacle.')
+            ds += 1
+        if len(msg) == 1: msg.append('Finding nothing new, you return to this domain.')
+        else: msg.append('You then return to this domain.')
+
+    legs = asyncio.ensure_future(travel(uid, here, dest, src, app, pending.get(uid)))
+    done, _ = await asyncio.wait([legs], timeout=journey_budget)
+    if not done:
+        pending[uid] = legs
+        legs.add_done_callback(lambda task: settle(uid, dest, task))
     return web.Response(text='\n'.join(msg))
 
-async def inventory(uid:int, rest:list[str]) -> web.Response:
+async def travel(uid:int, here:int, dest:int, src:str, app:web.Application, after:asyncio.Task|None=None) -> bool:
+    """The outbound legs of a journey: /depart from here and /arrive at dest.
+
+    Waits for an earlier journey's legs first so domains see a user's moves in order.
+    A failed /arrive is tried once more; returns whether the user arrived.
+    """
+    with tracing.span('travel'):
+        if after is not None:
+            await asyncio.wait([after])
+        if dest == here: # the domain has to see the departure before the return
+            await depart(uid, here, app)
+            came = await arrive(uid, dest, app, src)
+        else:
+            _, came = await asyncio.gather(depart(uid, here, app), arrive(uid, dest, app, src))
+        return came or await arrive(uid, dest, app, src)
+
+def settle(uid:int, dest:int, legs:asyncio.Task) -> None:
+    """Reconciles a journey whose legs finished after its player was answered
+
+    If the user never arrived, the failure is counted and the player told on
+    their /events streams, since the answer they got assumed it would work.
+    """
+    if pending.get(uid) is legs:
+        del pending[uid]
+    if legs.cancelled() or legs.exception() is not None or not legs.result():
+        print('ERROR: late journey legs for user', uid, 'did not complete')
+        metrics.count('hub_journeys_unfinished_total')
+        publish(uid, 'journey', {'domain':dest, 'arrived':False,
+            'text':'Your journey to '+domains[dest]['name']+' did not finish; its domain is not responding'})
+
+async def settled(uid:int) -> None:
+    """Waits, within the journey budget, for a user's late journey legs to land"""
+    if uid in pending:
+        await asyncio.wait([pending[uid]], timeout=journey_budget)
+
+@command('inventory')
+async def inventory(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Display what the user is carrying"""
-    me = users[uid]
-    if not any(v == 'inventory' for v in me['inventory'].values()):
+    gear = users[uid]['where'].get('inventory')
+    if not gear:
         return web.Response(text='You are not carrying anything.')
-    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in me['inventory'] if me['inventory'][tid] == 'inventory'))
+    return web.Response(text='You are carrying:<ul>'+''.join(f'<li>{templates[tid]["name"]} <sub>{tid}</sub></li>' for tid in gear))
 
-async def score(uid:int, rest:list[str]) -> web.Response:
+@command('score')
+async def score(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Display the scoreboard"""
-    ans = f'Score for user {uid}:<ul>'
-    points = 0
-    for k,v in users[uid]['score'].items():
-        ans += f'<li>Domain {k}: {v} points</li>'
-        points += v
-    ans += f'<li>Others: {round(users[uid]["domstate"]/2,2)} points</li>'
-    ans += f'</ul>Total: {points+round(users[uid]["domstate"]/2,2)} points.'
-        
-    return web.Response(text=ans)
+    me = users[uid]
+    return web.Response(text=f'Score for user {uid}:<ul>'
+        + ''.join(f'<li>Domain {k}: {v} points</li>' for k,v in me['score'].items())
+        + f'<li>Others: {round(me["domstate"]/2,2)} points</li>'
+        + f'</ul>Total: {total_points(uid)} points.'
+        + f' You are ranked {leaderboard.rank(uid)} of {len(leaderboard.points)}.')
+
+@routes.get("/leaderboard")
+async def ranking(req : web.Request) -> web.Response:
+    """Ranks users by total points
+    
+    Query parameters, all optional:
+    top: how many of the highest-scoring users to list (default 10)
+    user: a user id to report the rank and percentile of
+    above: a point total to count the users with more points than
+    
+    In a multi-process hub each worker ranks only its own users; the router combines them.
+    """
+    try:
+        k = int(req.query.get('top', 10))
+        uid = int(req.query['user']) if 'user' in req.query else None
+        total = float(req.query['above']) if 'above' in req.query else None
+    except ValueError:
+        return codec.json_response(status=400, data={"error":"top and user must be integers, above a number"})
+    if uid is not None and uid not in leaderboard.points:
+        return codec.json_response(status=404, data={"error":f"User {uid} not known"})
+    ans = {'users':len(leaderboard.points), 'top':leaderboard.top(max(0, min(k, 1000)))}
+    if uid is not None:
+        ans['user'] = {'user':uid, 'points':leaderboard.points[uid]/1000,
+            'rank':leaderboard.rank(uid), 'percentile':leaderboard.percentile(uid)}
+    if total is not None:
+        ans['above'] = leaderboard.above(total)
+    return codec.json_response(data=ans)
+
+
+async def depart(uid: int, did: int, app:web.Application) -> bool:
+    """Alert a domain that a user has left"""
+    here = domains[did]
+    try:
+        async with app.links[did].post('/depart', json={
+            'secret':here['secret'],
+            'user':uid,
+        }, timeout=ClientTimeout(total=leg_timeout)) as resp:
+            if not resp.ok:
+                print("/depart returned a failing status code", resp.status)
+            return resp.ok
+    except Exception as ex:
+        print("/depart failed", ex)
+        return False
 
+def arrival(uid: int, dest: int, src:str) -> dict:
+    """The body of an /arrive call, without the domain's secret"""
+    me = users[uid]
+    mine = me['homed'].get(dest, {})
+    gear = me['where'].get('inventory', ())
+    owned = [brief(tid) for tid in mine]
+    carried = [brief(tid) for tid in gear if tid not in mine]
+    dropped = [brief(tid) | {'location':me['inventory'][tid][1]} for tid in me['dropped'].get(dest, ())]
+    prize = [view for tid,view in loot_briefs.get(dest, ()) if tid not in me['inventory']]
+    
+    if dest not in me['score']:
+        change('score', uid, dest, 0)
+    
+    return {
+        'user':uid,
+        'from':src,
+        'owned':owned,
+        'carried':carried,
+        'dropped':dropped,
+        'prize':prize,
+    }
 
-async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> None:
+async def arrive(uid: int, dest: int, app:web.Application, src:str='login') -> bool:
     """Alert a domain that a user has arrived"""
-    owned, carried, dropped, prize = [],[],[],[]
-    for tid, loc in users[uid]['inventory'].items():
-        t = templates[tid]
-        brief = {k:v for k,v in t.items() if k in ('name','description','verb')}
-        brief['id'] = tid
-        if loc == 'inventory':
-            if t['home'] == dest:
-                owned.append(brief)
-            else: carried.append(brief)
-        elif loc[0] == dest:
-            brief['location'] = loc[1]
-            dropped.append(brief)
-    for tid in domains[dest]['loot']:
-        if tid not in users[uid]['inventory']:
-            t = templates[tid]
-            brief = {k:v for k,v in t.items() if k in ('name','description','verb','depth')}
-            brief['id'] = tid
-            prize.append(brief)
-    
-    users[uid]['score'].setdefault(dest, 0)
-    
     try:
-        async with app.client.post(domains[dest]['url']+'/arrive', json={
+        async with app.links[dest].post('/arrive', json={
             'secret':domains[dest]['secret'],
-            'user':uid,
-            'from':src,
-            'owned':owned,
-            'carried':carried,
-            'dropped':dropped,
-            'prize':prize,
-        }) as resp:
-            assert resp.status == 200, (resp.status, await resp.read())
-    except BaseException as ex:
+        } | arrival(uid, dest, src), timeout=ClientTimeout(total=leg_timeout)) as resp:
+            if resp.status == 200: return True
+            print('ERROR:',domains[dest]['url']+'/arrive','returned',resp.status,await resp.read())
+            return False
+    except Exception as ex:
         print('ERROR:',domains[dest]['url']+'/arrive','did not work',repr(ex))
+        return False
 
+async def arrive_batch(uids: list[int], dest: int, app:web.Application, src:str='login') -> list[bool]:
+    """Alert a domain that several users have arrived, with one /arrive_batch call if it supports that
+    
+    If the batch fails, each user is sent a /arrive of their own instead.
+    Returns whether each user arrived.
+    """
+    here = domains[dest]
+    if here.get('batch', True):
+        try:
+            async with app.links[dest].post('/arrive_batch', json={
+                'secret':here['secret'],
+                'arrivals':[arrival(uid, dest, src) for uid in uids],
+            }, timeout=ClientTimeout(total=leg_timeout)) as resp:
+                if resp.status == 200:
+                    return [True]*len(uids)
+                if resp.status in (404, 405):
+                    here['batch'] = False # an older domain: fall back to one /arrive per user
+                else:
+                    print('ERROR:',here['url']+'/arrive_batch','returned',resp.status,await resp.read())
+        except Exception as ex:
+            print('ERROR:',here['url']+'/arrive_batch','did not work',repr(ex))
+    return await asyncio.gather(*(arrive(uid, dest, app, src) for uid in uids))
+
+@command('drop', nargs=(1,None), usage='What do you want to drop?\n><code>inventory</code> will show your options',
+    limits=('command','travel'))
 async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
     """Called by users to drop items where they are"""
-    if len(rest) == 0:
-        return web.Response(text='What do you want to drop?\n><code>inventory</code> will show your options')
-    
     me = users[uid]
-    gear = [tid for tid,where in me['inventory'].items() if where == 'inventory']
+    gear = me['where'].get('inventory', {})
     
     todrop = ' '.join(rest)
     
-    if todrop in [str(tid) for tid in gear]:
+    if todrop.isascii() and todrop.isdigit() and int(todrop) in gear and str(int(todrop)) == todrop:
         item = int(todrop)
     else:
-        todrop = [tid for tid in gear if templates[tid]['name'] == todrop]
+        todrop = list(me['named'].get(todrop, ()))
         if len(todrop) == 0:
             return web.Response(text='You have no '+' '.join(rest)+' to drop')
         if len(todrop) > 1:
@@ -368,19 +1262,22 @@ async def drop(uid:int, rest:list[str], app:web.Application) -> web.Response:
             +'</ul')
         item = todrop[0]
     
+    await settled(uid)
     did = users[uid]['in']
     spot = None
     try:
-        async with app.client.post(domains[did]['url']+'/dropped', json={
+        async with app.links[did].post('/dropped', json={
             'secret':domains[did]['secret'],
             'user':uid,
-            'item':{'id':item} | {k:v for k,v in templates[item].items() if k in ('name','description','verb')},
+            'item':brief(item),
         }) as resp:
-            spot = await resp.json()
+            spot = await codec.read(resp)
+    except DomainDegraded:
+        return web.Response(text="You try to drop it, but this domain is not responding right now")
     except:
         return web.Response(text="You try to drop it, but the domain won't let you")
     
-    me['inventory'][item] = (did, spot)
+    change('item', uid, item, (did, spot))
     
     return web.Response(text=templates[item]['name']+f" <sub>{item}</sub> dropped.")
 
@@ -395,40 +1292,41 @@ async def register_domain(req : web.Request) -> web.Response:
     """Registers a domain, if the server is in the domain-registering mode"""
     if mode != 'setup':
         return web.Response(status=409, text="Central server is not in setup mode")
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
     if 'name' not in data or not isinstance(data['name'], str):
-        return web.json_response(status=400, data={"error":"Name string required"})
+        return codec.json_response(status=400, data={"error":"Name string required"})
     if 'description' not in data or not isinstance(data['description'], str):
-        return web.json_response(status=400, data={"error":"Description string required"})
+        return codec.json_response(status=400, data={"error":"Description string required"})
     if 'url' not in data or not isinstance(data['url'], str):
-        return web.json_response(status=400, data={"error":"Sever url required"})
+        return codec.json_response(status=400, data={"error":"Sever url required"})
     if 'items' not in data or not isinstance(data['items'], list) or any(not isinstance(item, dict) for item in data['items']):
-        return web.json_response(status=400, data={"error":"List of item templates required"})
+        return codec.json_response(status=400, data={"error":"List of item templates required"})
     for i,d in domains.items():
         if d['url'] == data['url']:
-            return web.json_response(status=409, data={"error":"Cannot register same domain more than once"})
-    if len(domains) > 1:
-        return web.Response(status=409, text="MP10's hub server only supports a single domain at a time.")
-    did = random.randrange(1000) # only one domain, but fake a different ID for each
+            return codec.json_response(status=409, data={"error":"Cannot register same domain more than once"})
+    did = random.randrange(1000 + 4*len(domains))
+    while did in domains: did = random.randrange(1000 + 4*len(domains))
     secret = make_secret()
     domains[did] = {
         'url':data['url'],
         'name':data['name'],
         'description':data['description'],
         'secret':secret,
+        'codecs':[kind for kind in data.get('codecs', ()) if kind in codec.encoders],
     }
+    domain_ids.append(did)
     ids = []
-    t0 = random.randrange(1000)
-    for item in data['items']:
-        tid = len(templates)+t0
+    t0 = max(templates)+1 if templates else random.randrange(1000)
+    for i,item in enumerate(data['items']):
+        tid = t0+i
         templates[tid] = {'name':item.get('name','thing'), 'description':item.get('description','error: owner did not describe this item'), 'verb':item.get('verb',{}), 'home':did}
         ids.append(tid)
         if 'depth' in item and isinstance(item['depth'], int):
             templates[tid]['depth'] = max(0,item['depth'])
         
 
-    return web.json_response({'id':did,"items":ids,'secret':secret})
+    return codec.respond(req, {'id':did,"items":ids,'secret':secret,'key':domain_key(did).hex(),'codecs':codec.available})
 
 @routes.post("/score")
 async def transfer(req: web.Request) -> web.Response:
@@ -442,23 +1340,23 @@ async def transfer(req: web.Request) -> web.Response:
     
     Finding Secret areas may add multiples of 0.001 points, to a maximum of 1.005.
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
     did = checkdid(data)
     if isinstance(did, web.Response): return did
     uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
+    if not resident(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
     try:
         score = float(data['score'])
     except:
-        return web.json_response(status=400, data={"error":"Numeric score required"})
+        return codec.json_response(status=400, data={"error":"Numeric score required"})
     if score < 0 or score > 1.005:
-        return web.json_response(status=400, data={"error":"Invalid score; should be between 0 and 1"})
+        return codec.json_response(status=400, data={"error":"Invalid score; should be between 0 and 1"})
     if score < users[uid]['score'].get(did,0):
-        return web.json_response(status=409, data={"error":"Reducing scores is not supported"})
-    users[uid]['score'][did] = score
-    return web.json_response(data={"ok":"Score changed"})
+        return codec.json_response(status=409, data={"error":"Reducing scores is not supported"})
+    change('score', uid, did, score)
+    return codec.respond(req, {"ok":"Score changed"})
 
 @routes.post("/transfer")
 async def transfer(req: web.Request) -> web.Response:
@@ -475,18 +1373,18 @@ async def transfer(req: web.Request) -> web.Response:
     Any other destination names some location within the sending domain (as if dropped).
     
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
     did = checkdid(data)
     if isinstance(did, web.Response): return did
     uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
+    if not resident(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
     tid = data.get('item')
     if tid not in templates:
-        return web.json_response(status=400, data={"error":"Valid item ID required"})
+        return codec.json_response(status=400, data={"error":"Valid item ID required"})
     if 'to' not in data:
-        return web.json_response(status=400, data={"error":"Missing \"to\" field"})
+        return codec.json_response(status=400, data={"error":"Missing \"to\" field"})
     
     old = users[uid]['inventory'].get(tid)
     new = data['to']
@@ -494,22 +1392,20 @@ async def transfer(req: web.Request) -> web.Response:
     
     
     if old == new:
-        return web.json_response(status=409, data={"error":"Cannot move item to where it already is"})
+        return codec.json_response(status=409, data={"error":"Cannot move item to where it already is"})
     
     if old is None and not owned:
-        return web.json_response(status=403, data={"error":"Cannot generate items that don't belong to you"})
+        return codec.json_response(status=403, data={"error":"Cannot generate items that don't belong to you"})
     if old is not None and new != 'inventory' and templates[tid]['home'] != did:
-        return web.json_response(status=403, data={"error":"Cannot move or remove items that don't belong to you"})
+        return codec.json_response(status=403, data={"error":"Cannot move or remove items that don't belong to you"})
 
     if old is not None and old[0] != did:
-        return web.json_response(status=403, data={"error":"That item has been dropped in a different domain"})
+        return codec.json_response(status=403, data={"error":"That item has been dropped in a different domain"})
 
-    users[uid]['inventory'][tid] = new if new == 'inventory' else (did, new)
-    if users[uid]['inventory'][tid] == 'inventory':
-        users[uid]['hashad'].add(tid)
+    change('item', uid, tid, new if new == 'inventory' else (did, new))
 
 
-    return web.json_response(status=200, data={"ok":"Item transferred"})
+    return codec.respond(req, {"ok":"Item transferred"})
 
 
 @routes.post("/query")
@@ -527,38 +1423,860 @@ async def transfer(req: web.Request) -> web.Response:
     
     Return is a list of item ID.
     """
-    try: data = await req.json()
-    except: return web.json_response(status=400, data={"error":"JSON data required"})
+    try: data = await codec.read(req)
+    except: return codec.json_response(status=400, data={"error":"JSON data required"})
     did = checkdid(data)
     if isinstance(did, web.Response): return did
     uid = data.get('user')
-    if uid not in users:
-        return web.json_response(status=400, data={"error":"Valid user ID required"})
+    if not resident(uid):
+        return codec.json_response(status=400, data={"error":"Valid user ID required"})
     if ('location' in data) == ('depth' in data):
-        return web.json_response(status=400, data={"error":"Must provide location xor depth"})
+        return codec.json_response(status=400, data={"error":"Must provide location xor depth"})
 
     if 'location' in data:
         where = data['location']
         if where is None:
-            return web.json_response(status=400, data={"error":"Location required"})
+            return codec.json_response(status=400, data={"error":"Location required"})
         if where != 'inventory':
             where = (did, where)
-        resp = [iid for iid,loc in users[uid]['inventory'].items() if loc == where]
+        resp = list(users[uid]['where'].get(where_key(where), ()))
     else:
         resp = [iid for iid in domains[did]['loot'] if iid not in users[uid]['inventory'] and templates[iid].get('depth') == data['depth']]
     
-    return web.json_response(status=200, data=resp)
+    return codec.respond(req, resp)
+
+
+
+#################################################
+###  Section: write-ahead log and snapshots  ###
+
+def change(*entry) -> None:
+    """Makes a change to user state, logging it first if the hub is journaled"""
+    if journal is not None:
+        journal.record(entry)
+    apply(entry)
+
+def apply(entry:tuple) -> None:
+    """Makes a logged change to user state; also used to replay the log"""
+    global next_uid
+    kind, uid, *rest = entry
+    if kind != 'user' and uid not in users:
+        resident(uid) # evicted while the change was on its way
+    if kind == 'user':
+        users[uid] = rest[0]
+        last_seen[uid] = time.monotonic()
+        next_uid = max(next_uid, uid + worker_count)
+        leaderboard.update(uid, total_points(uid))
+    elif kind == 'item':
+        tid, loc = rest
+        place_item(users[uid], tid, loc)
+        if loc == 'inventory':
+            users[uid]['hashad'].add(tid)
+        if uid in listeners:
+            publish(uid, 'item', {'item':tid, 'name':templates[tid]['name'], 'at':loc})
+    elif kind == 'score':
+        did, points = rest
+        users[uid]['score'][did] = points
+        leaderboard.update(uid, total_points(uid))
+        if uid in listeners:
+            publish(uid, 'score', {'domain':did, 'points':points, 'total':total_points(uid)})
+    elif kind == 'domstate':
+        users[uid]['domstate'] = rest[0]
+        leaderboard.update(uid, total_points(uid))
+    elif kind == 'move':
+        users[uid]['in'] = rest[0]
+        if rest[0] not in users[uid]['open']:
+            users[uid]['open'].append(rest[0])
+
+def dump_world() -> dict:
+    """The read-mostly state every hub process shares; derived caches are rebuilt on load"""
+    return {'mode':mode, 'grid':grid, 'domains':domains, 'templates':templates,
+        'others_items':others_items, 'token_key':token_key}
+
+def dump_state() -> dict:
+    """Everything a snapshot needs"""
+    return dump_world() | {'users':users, 'next_uid':next_uid}
+
+def load_state(state:dict) -> None:
+    """Replaces the hub's state with a snapshot's"""
+    global next_uid
+    load_world(state)
+    users.clear()
+    users.update(state['users'])
+    next_uid = state['next_uid']
+    last_seen.clear()
+    leaderboard.clear()
+    for uid in users:
+        last_seen[uid] = time.monotonic()
+        leaderboard.update(uid, total_points(uid))
+    if idle_store is not None:
+        idle_store.count = 0
+        idle_store.reloaded.clear()
+        for uid, me in list(idle_store.records()):
+            if uid in users: # the snapshot is newer
+                idle_store.remove(uid)
+            else:
+                idle_store.count += 1
+                leaderboard.update(uid, points_of(me))
+
+def load_world(world:dict) -> None:
+    """Replaces the hub's domains, templates and map with those from dump_world()"""
+    global token_key
+    switch_mode(world['mode'])
+    token_key = world['token_key']
+    for name in 'grid','domains','templates':
+        globals()[name].clear()
+        globals()[name].update(world[name])
+    others_items[:] = world['others_items']
+    domain_ids[:] = domains
+    link_map()
+    briefs.clear()
+    prize_briefs.clear()
+    loot_briefs.clear()
+    for did in domains:
+        if 'loot' in domains[did]:
+            loot_briefs[did] = tuple((tid, prize_brief(tid)) for tid in domains[did]['loot'])
+    compile_awards()
+
+class Journal:
+    """Write-ahead log of state changes, compacted into periodic snapshots
+
+    Files come in generations: snapshot-N is the whole state as of the start
+    of wal-N, and wal-N holds the pickled change() entries made after it.
+    Snapshots are written by a forked child, so the hub keeps serving.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.gen = 0
+        self.count = 0 # entries in the current generation
+        self.file = None
+        self.flushing = False
+        self.writer = None # asyncio.Future for a snapshot being written
+
+    def name(self, kind:str, gen:int) -> str:
+        return os.path.join(self.path, f'{kind}-{gen:08d}')
+
+    def generations(self, kind:str) -> list[int]:
+        return sorted(int(f[len(kind)+1:]) for f in os.listdir(self.path)
+            if f.startswith(kind+'-') and f[len(kind)+1:].isdigit())
+
+    def restore(self) -> None:
+        """Rebuilds the hub's state from the newest readable snapshot and the logs after it"""
+        start = 0
+        for gen in reversed(self.generations('snapshot')):
+            try:
+                with open(self.name('snapshot', gen), 'rb') as f:
+                    load_state(pickle.load(f))
+                start = gen
+                break
+            except Exception as ex:
+                print('ERROR: snapshot', gen, 'is unreadable', repr(ex))
+        replayed = 0
+        for gen in self.generations('wal'):
+            if gen < start: continue
+            with open(self.name('wal', gen), 'rb') as f:
+                while True:
+                    try: entry = pickle.load(f)
+                    except EOFError: break
+                    except Exception: # torn write at the moment of a crash
+                        print('ERROR: log', gen, 'ends with a partial entry')
+                        break
+                    apply(entry)
+                    replayed += 1
+        self.gen = max(self.generations('wal') + self.generations('snapshot') + [0])
+        print(f'Restored {len(users)} users from {self.path}, replaying {replayed} logged changes')
+
+    def record(self, entry:tuple) -> None:
+        """Appends an entry; entries are flushed together once per event-loop pass"""
+        pickle.dump(entry, self.file, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        self.flushing = False
+        self.file.flush()
+        if self.count >= snapshot_every:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Starts the next log generation and writes the state it begins from"""
+        if self.writer is not None: return
+        if self.file is not None: self.file.close()
+        self.gen += 1
+        self.count = 0
+        self.file = open(self.name('wal', self.gen), 'ab')
+        gen = self.gen
+        covered = idle_store.covered() if idle_store is not None else set()
+        if not hasattr(os, 'fork'):
+            self.write(gen)
+            self.prune(gen, covered)
+            return
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self.write(gen)
+                code = 0
+            finally:
+                os._exit(code)
+        self.writer = asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+        self.writer.add_done_callback(lambda done: self.written(gen, covered, done))
+
+    async def idle(self) -> None:
+        """Waits for any snapshot being written, so the next one is not skipped"""
+        if self.writer is not None: await self.writer
+
+    def write(self, gen:int) -> None:
+        tmp = self.name('snapshot', gen)+'.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(dump_state(), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.name('snapshot', gen))
+
+    def written(self, gen:int, covered:set, done:asyncio.Future) -> None:
+        self.writer = None
+        if done.exception() is None and os.waitstatus_to_exitcode(done.result()[1]) == 0:
+            self.prune(gen, covered)
+        else:
+            print('ERROR: snapshot', gen, 'was not written')
+            if idle_store is not None: idle_store.reloaded |= covered
+
+    def prune(self, gen:int, covered:set) -> None:
+        """Removes the generations, and the idle users' files, a new snapshot makes redundant"""
+        for kind in 'snapshot','wal':
+            for old in self.generations(kind):
+                if old < gen: os.remove(self.name(kind, old))
+        if idle_store is not None: idle_store.forget(covered)
+
+    async def close(self) -> None:
+        await self.idle()
+        self.file.close()
+
+
+#############################
+###  Section: world files  ###
+
+def save_world(path:str) -> None:
+    """Writes the domains, templates, map and loot as a file that --world can start from"""
+    world = {
+        'hub':{'url':whoami, 'codecs':codec.available},
+        'token_key':token_key.hex(),
+        'domains':[{
+            'id':did,
+            'url':d['url'],
+            'name':d['name'],
+            'description':d['description'],
+            'secret':d['secret'],
+            'key':domain_key(did).hex(),
+            'codecs':d.get('codecs', []),
+            'cell':d['cell'],
+            'loot':d['loot'],
+            'items':[{'id':tid} | {k:t[k] for k in ('name','description','verb','depth') if k in t}
+                for tid,t in templates.items() if t['home'] == did],
+        } for did,d in domains.items()],
+        'outside':[{k:item[k] for k in ('id','name','description','verb','depth')} for item in others_items],
+    }
+    with open(path+'.tmp', 'w') as f:
+        json.dump(world, f, indent=1)
+    os.replace(path+'.tmp', path)
+
+def world_problem(world) -> str | None:
+    """What is wrong with a --world file's contents, or None if preload() can use it"""
+    integer = lambda value: isinstance(value, int) and not isinstance(value, bool)
+    if not isinstance(world, dict): return 'expected a JSON object'
+    if not isinstance(world.get('hub', {}), dict): return '"hub" should be an object'
+    if 'token_key' in world:
+        try: bytes.fromhex(world['token_key'])
+        except (TypeError, ValueError): return '"token_key" should be hexadecimal'
+    entries = world.get('domains')
+    if not isinstance(entries, list) or not entries: return '"domains" should be a non-empty list'
+    outside = world.get('outside', [])
+    if not isinstance(outside, list): return '"outside" should be a list'
+    dids, tids, cells = set(), set(), set()
+    for n, entry in enumerate(entries):
+        if not isinstance(entry, dict): return f'domain {n} should be an object'
+        if not integer(entry.get('id')): return f'domain {n} needs an integer "id"'
+        if entry['id'] in dids: return f'domain id {entry["id"]} is used twice'
+        dids.add(entry['id'])
+        for key in 'url','name','description','secret':
+            if not isinstance(entry.get(key), str): return f'domain {entry["id"]} needs a string "{key}"'
+        if not isinstance(entry.get('codecs', []), list): return f'domain {entry["id"]} "codecs" should be a list'
+        if 'cell' in entry:
+            cell = entry['cell']
+            if not isinstance(cell, list) or len(cell) != 2 or not all(integer(x) for x in cell):
+                return f'domain {entry["id"]} "cell" should be two integers'
+            if tuple(cell) in cells: return f'two domains are in cell {cell}'
+            cells.add(tuple(cell))
+        if not isinstance(entry.get('items'), list): return f'domain {entry["id"]} needs a list of "items"'
+    for item in [item for entry in entries for item in entry['items']] + outside:
+        if not isinstance(item, dict) or not integer(item.get('id')): return 'every item needs an integer "id"'
+        if item['id'] in tids: return f'item id {item["id"]} is used twice'
+        tids.add(item['id'])
+        if not isinstance(item.get('verb', {}), dict): return f'item {item["id"]} "verb" should be an object'
+    for item in outside:
+        for key, kind in ('name',str), ('description',str), ('verb',dict), ('depth',int):
+            if not isinstance(item.get(key), kind): return f'outside item {item["id"]} needs "{key}"'
+    for entry in entries:
+        loot = entry.get('loot', [])
+        if not isinstance(loot, list): return f'domain {entry["id"]} "loot" should be a list'
+        for tid in loot:
+            if tid not in tids: return f'domain {entry["id"]} loot {tid!r} is not an item id'
+    return None
+
+def preload(path:str) -> None:
+    """Sets up domains, templates, map and loot from a --world file and enters play mode
+
+    Each domain needs its id, url, name, description, secret and items, each
+    item its id; "cell" and "loot" may be left out for the hub to choose, but
+    only for every domain at once. A domain server started with the same file
+    knows its id, secret and item ids without registering.
+    """
+    global token_key
+    try:
+        with open(path) as f:
+            world = json.load(f)
+    except (OSError, ValueError) as ex:
+        raise SystemExit(f'Cannot read world file {path}: {ex}')
+    problem = world_problem(world)
+    if problem:
+        raise SystemExit(f'Bad world file {path}: {problem}')
+    if 'token_key' in world:
+        token_key = bytes.fromhex(world['token_key'])
+    for entry in world['domains']:
+        did = entry['id']
+        domains[did] = {k:entry[k] for k in ('url','name','description','secret')} | {'codecs':entry.get('codecs', [])}
+        domain_ids.append(did)
+        for item in entry['items']:
+            templates[item['id']] = {'name':item.get('name','thing'), 'description':item.get('description',''),
+                'verb':item.get('verb',{}), 'home':did} | ({'depth':item['depth']} if 'depth' in item else {})
+    for item in world.get('outside', []):
+        others_items.append(item | {'home':-1})
+    if all('cell' in entry for entry in world['domains']):
+        for entry in world['domains']:
+            domains[entry['id']]['cell'] = entry['cell']
+            grid[tuple(entry['cell'])] = entry['id']
+        link_map()
+    else:
+        make_map()
+    if all('loot' in entry for entry in world['domains']):
+        for item in others_items:
+            templates[item['id']] = item
+        for entry in world['domains']:
+            domains[entry['id']]['loot'] = entry['loot']
+            for tid in entry['loot']:
+                templates[tid]['hosts'] = [entry['id']]
+            loot_briefs[entry['id']] = tuple((tid, prize_brief(tid)) for tid in entry['loot'])
+        compile_awards()
+    else:
+        assign_loot()
+    switch_mode('play')
+    print(f'Loaded {len(domains)} domains and {len(templates)} items from {path}')
 
 
+###################################
+###  Section: idle user eviction  ###
+
+class IdleStore:
+    """Users evicted from memory, one pickle file each, read back when they are next needed
+
+    With a journal, a user's file is left in place when they are read back, as
+    until a snapshot includes them again only the file, the older snapshots and
+    the log together describe them; forget() removes it once one does. Without
+    one nothing outlives the hub, so the file goes as soon as it has been read.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.count = 0 # users evicted right now
+        self.reloaded = set() # user ids read back since the last snapshot began
+
+    def covered(self) -> set:
+        """The users read back that a snapshot starting now will include, and so whose files it makes redundant"""
+        covered = {uid for uid in self.reloaded if uid in users}
+        self.reloaded.clear()
+        return covered
+
+    def forget(self, uids) -> None:
+        """Removes the files of the users who are still in memory"""
+        for uid in uids:
+            if uid in users: self.remove(uid)
+
+    def remove(self, uid:int) -> None:
+        try: os.remove(self.name(uid))
+        except FileNotFoundError: pass
+
+    def name(self, uid:int) -> str:
+        return os.path.join(self.path, f'{uid % 256:02x}', f'{uid}.pickle')
+
+    def save(self, uid:int, me:dict) -> None:
+        name = self.name(uid)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name+'.tmp', 'wb') as f:
+            pickle.dump(me, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(name+'.tmp', name)
+
+    def load(self, uid:int) -> dict|None:
+        try:
+            with open(self.name(uid), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def records(self):
+        """Every (user id, user) in the store"""
+        for folder, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith('.pickle'):
+                    with open(os.path.join(folder, name), 'rb') as f:
+                        yield int(name[:-len('.pickle')]), pickle.load(f)
+
+def resident(uid) -> bool:
+    """Whether uid is a known user, reading them back into users if they were evicted, and marking them active"""
+    if uid not in users:
+        if idle_store is None or not isinstance(uid, int): return False
+        me = idle_store.load(uid)
+        if me is None: return False
+        users[uid] = me
+        idle_store.count -= 1
+        if journal is None: idle_store.remove(uid)
+        else: idle_store.reloaded.add(uid)
+        metrics.count('hub_users_reloaded_total')
+    last_seen[uid] = time.monotonic()
+    last_seen.move_to_end(uid)
+    return True
+
+def evict(now:float) -> int:
+    """Moves idle users, and the least recently active beyond max_resident, to idle_store; returns how many"""
+    evicted = 0
+    for _ in range(len(last_seen)):
+        uid, seen = next(iter(last_seen.items()))
+        if now - seen < idle_ttl and (not max_resident or len(users) <= max_resident): break
+        del last_seen[uid]
+        if uid in pending or uid in listeners or uid in active: # not idle, just quiet
+            last_seen[uid] = now
+            continue
+        if uid in users:
+            idle_store.save(uid, users.pop(uid))
+            idle_store.count += 1
+            buckets.pop(uid, None)
+            evicted += 1
+    if evicted: metrics.count('hub_users_evicted_total', evicted)
+    return evicted
+
+async def evict_idle() -> None:
+    """Runs evict() every idle_sweep_every seconds"""
+    while True:
+        await asyncio.sleep(idle_sweep_every)
+        evict(time.monotonic())
+
+
+##############################
+###  Section: metrics  ###
+
+# Inventory sizes are bucketed by item count rather than by seconds
+inventory_bounds = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+@metrics.gauge('hub_users', 'Users in memory, by the domain they are in')
+def users_by_domain() -> dict:
+    return {(('domain', did),): n for did,n in collections.Counter(me['in'] for me in users.values()).items()}
+
+@metrics.gauge('hub_inventory_items', 'Items each user carries')
+def inventory_sizes() -> metrics.Histogram:
+    sizes = metrics.Histogram(inventory_bounds)
+    for me in users.values():
+        sizes.observe(len(me['where'].get('inventory', ())))
+    return sizes
+
+@metrics.gauge('hub_users_idle', 'Users moved out of memory to the idle store, and not yet read back')
+def idle_users() -> int:
+    return idle_store.count if idle_store is not None else 0
+
+@metrics.gauge('hub_pending_journeys', 'Journeys whose outbound legs are still running')
+def pending_journeys() -> int:
+    return len(pending)
+
+@metrics.gauge('hub_command_rejected', 'Commands refused for their arguments')
+def rejected_commands() -> dict:
+    return {(('command', name),): cmd.rejected for name,cmd in commands.items()}
+
+metrics.describe('hub_command_seconds', 'Time to run a hub command')
+metrics.describe('hub_command_error_seconds', 'Time to run hub commands that failed')
+metrics.describe('hub_domain_call_seconds', 'Time for a domain to answer a call from the hub, by domain and path')
+metrics.describe('hub_domain_call_seconds_failures_total', 'Calls to a domain that got no answer')
+metrics.describe('hub_journeys_unfinished_total', 'Journeys answered within the budget whose /arrive then failed, even when retried')
+metrics.describe('hub_events_dropped_total', 'Events dropped because a player\'s /events stream fell behind')
+metrics.describe('hub_ws_message_seconds', 'Time to answer a /ws message, by whether it was for the hub or a domain')
+metrics.describe('hub_commands_throttled_total', 'Hub commands refused with 429 because their user exceeded a rate limit')
+metrics.describe('hub_users_evicted_total', 'Idle users moved from memory to the idle store')
+metrics.describe('hub_users_reloaded_total', 'Users read back from the idle store when they returned')
+
+
+#########################################
+###  Section: multi-process hub mode  ###
+
+# Routes only workers serve, reached through their unix socket
+worker_routes = web.RouteTableDef()
+
+def pack_world() -> bytes:
+    """dump_world() as JSON, with the keys JSON lacks (tuples, integers, bytes) spelled out"""
+    world = dump_world()
+    return codec.dumps(world | {'grid':[[x, y, did] for (x, y), did in world['grid'].items()],
+        'domains':list(world['domains'].items()), 'templates':list(world['templates'].items()),
+        'token_key':world['token_key'].hex()})
+
+def unpack_world(body:bytes) -> dict:
+    """The dump_world() that pack_world() encoded"""
+    world = codec.loads(body)
+    return world | {'grid':{(x, y):did for x, y, did in world['grid']},
+        'domains':dict(world['domains']), 'templates':dict(world['templates']),
+        'token_key':bytes.fromhex(world['token_key'])}
+
+@worker_routes.get("/_world")
+async def send_world(req : web.Request) -> web.Response:
+    """Lets the router copy the primary worker's world to the other workers"""
+    return web.Response(body=pack_world(), content_type=codec.JSON)
+
+@worker_routes.post("/_world")
+async def receive_world(req : web.Request) -> web.Response:
+    """Adopts the primary worker's world when play starts"""
+    try: world = unpack_world(await req.read())
+    except (ValueError, TypeError, KeyError): return codec.json_response(status=400, data={"error":"World expected"})
+    load_world(world)
+    await announce({'mode':mode})
+    await open_links(req.app)
+    if journal is not None:
+        await journal.idle()
+        journal.snapshot()
+    return web.Response(text="Now in "+mode+" mode")
+
+@worker_routes.post("/_message")
+async def receive_message(req : web.Request) -> web.Response:
+    """Answers a /ws message the router received for a user of this worker"""
+    try: data = codec.loads(await req.text())
+    except ValueError: data = None
+    return codec.json_response(data=await deliver(data, req.app))
+
+tracing.quiet.add('/_message') # deliver() traces it
+
+def serve_worker(index:int, args, public_url:str, path:str) -> None:
+    """Runs one partition of a multi-process hub on a unix socket"""
+    global worker_index, worker_count, next_uid
+    worker_index, worker_count = index, args.workers
+    next_uid = index
+    configure(args, public_url, os.path.join(args.state, f'worker-{index}') if args.state else None, args.world if index == 0 else None)
+    app = make_app()
+    app.add_routes(worker_routes)
+    web.run_app(app, path=path, print=None)
+
+class Router:
+    """Front process of a multi-process hub
+
+    Requests naming a user go to the worker that owns them, logins are spread
+    across workers, and everything else goes to the primary worker (worker 0),
+    whose world is copied to every other worker when play starts. Paths
+    starting /_ are the workers' own and are not served to the outside.
+    """
+    def __init__(self, paths:list[str]):
+        self.paths = paths
+        self.turn = 0
+        self.sockets = set() # open /ws connections, which the router answers itself
+
+    async def start(self, app:web.Application) -> None:
+        from aiohttp import UnixConnector
+        self.workers = [ClientSession(base_url='http://hub', connector=UnixConnector(path=path), auto_decompress=False) for path in self.paths]
+        for worker in self.workers: # wait for each worker to be listening
+            while True:
+                try:
+                    async with worker.get('/mode') as resp: break
+                except ClientConnectionError:
+                    await asyncio.sleep(0.05)
+        behind = []
+        for worker in self.workers: # the primary may have preloaded a world the others lack
+            async with worker.get('/mode') as resp:
+                behind.append(await resp.text() != 'play')
+        if not behind[0]:
+            await self.share_world([worker for worker,late in zip(self.workers, behind) if late])
+
+    async def share_world(self, workers:list[ClientSession]) -> None:
+        """Copies the primary worker's world to workers"""
+        async with self.workers[0].get('/_world') as got:
+            world = await got.read()
+        for worker in workers:
+            async with worker.post('/_world', data=world) as sent:
+                if sent.status != 200:
+                    raise RuntimeError(f'a worker refused the world: {sent.status} {await sent.text()}')
+
+    async def stop(self, app:web.Application) -> None:
+        for worker in self.workers:
+            await worker.close()
+
+    async def relay(self, index:int, req:web.Request, body:bytes) -> web.Response:
+        """Passes a request to a worker and its answer back"""
+        async with self.workers[index].request(req.method, req.rel_url, data=body,
+            headers={k:v for k,v in req.headers.items() if k.lower() not in ('host','content-length','transfer-encoding')}) as resp:
+            return web.Response(status=resp.status, body=await resp.read(),
+                headers={k:v for k,v in resp.headers.items() if k.lower() not in ('content-length','transfer-encoding','connection','date','server')})
+
+    @staticmethod
+    def owner(body:bytes, kind:str=codec.JSON) -> int | None:
+        """The user a request body of Content-Type kind is about: its "user", or else the one its session token names"""
+        try: data = codec.decode(body, kind)
+        except ValueError: return None
+        if not isinstance(data, dict): return None
+        if 'user' in data: return data['user']
+        uid = str(data.get('token', '')).split('.')[0]
+        return int(uid) if uid.isascii() and uid.isdigit() else None
+
+    async def route(self, req:web.Request) -> web.Response:
+        if req.path.startswith('/_'): # worker_routes, only for the router itself
+            return codec.json_response(status=404, data={"error":"Not found"})
+        body = await req.read()
+        if req.method == 'POST' and req.path in ('/command','/transfer','/query','/score','/token'):
+            uid = self.owner(body, req.content_type)
+            return await self.relay(uid % len(self.workers) if isinstance(uid, int) else 0, req, body)
+        if req.path == '/healthz':
+            return web.Response(text='ok')
+        if req.path == '/readyz':
+            return await self.ready()
+        if req.path == '/leaderboard' and req.method == 'GET':
+            return await self.leaderboard(req)
+        if req.path == '/metrics' and req.method == 'GET':
+            return await self.metrics()
+        if req.path == '/traces' and req.method == 'GET':
+            return await self.traces(req)
+        if req.path == '/ws' and req.method == 'GET':
+            return await self.websocket(req)
+        if req.path == '/events' and req.method == 'GET':
+            return await self.events(req)
+        if req.path == '/login':
+            if req.method == 'POST':
+                return await self.bulk_login(req, body)
+            self.turn = (self.turn + 1) % len(self.workers)
+            return await self.relay(self.turn, req, body)
+        resp = await self.relay(0, req, body)
+        if req.method == 'POST' and req.path == '/mode' and resp.status == 200 and resp.text.startswith('Now in play'):
+            await self.share_world(self.workers[1:])
+        if req.method == 'POST' and req.path == '/mode' and resp.status == 200 and resp.text.startswith('Now in'):
+            for ws in list(self.sockets):
+                try: await ws.send_json({'mode':resp.text.split()[2]})
+                except (ConnectionError, RuntimeError): self.sockets.discard(ws)
+        return resp
+
+    async def events(self, req:web.Request) -> web.StreamResponse:
+        """Streams /events from the worker owning the user"""
+        uid = req.query.get('user', '')
+        worker = self.workers[int(uid) % len(self.workers) if uid.isascii() and uid.isdigit() else 0]
+        async with worker.get('/events', params=req.query, timeout=ClientTimeout(total=None, sock_read=None)) as got:
+            if got.status != 200:
+                return web.Response(status=got.status, body=await got.read(), content_type=got.content_type)
+            resp = web.StreamResponse(headers={'Content-Type':'text/event-stream', 'Cache-Control':'no-cache'})
+            await resp.prepare(req)
+            try:
+                async for chunk in got.content.iter_any():
+                    await resp.write(chunk)
+            except ConnectionError:
+                pass
+            return resp
+
+    async def websocket(self, req:web.Request) -> web.WebSocketResponse:
+        """Answers /ws messages by passing each to the worker owning its user"""
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(req)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT: continue
+                try: data = codec.loads(msg.data)
+                except ValueError: data = None
+                uid = data.get('body', {}).get('user') if isinstance(data, dict) and isinstance(data.get('body'), dict) else None
+                try:
+                    async with self.workers[uid % len(self.workers) if isinstance(uid, int) else 0].post('/_message', data=msg.data) as resp:
+                        await ws.send_str(await resp.text())
+                except ClientError as ex:
+                    await ws.send_str(codec.dumps({'id':data.get('id') if isinstance(data, dict) else None,
+                        'status':502, 'text':'Worker unavailable: '+repr(ex)}).decode())
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def ready(self) -> web.Response:
+        """Ready when every worker is, counting users across all of them"""
+        async def ask(worker):
+            try:
+                async with worker.get('/readyz') as resp:
+                    return await codec.read(resp)
+            except ClientConnectionError:
+                return {'ready':False}
+        answers = await asyncio.gather(*(ask(worker) for worker in self.workers))
+        ready = all(got['ready'] for got in answers)
+        return codec.json_response(status=200 if ready else 503, data={'ready':ready,
+            'mode':answers[0].get('mode'), 'domains':answers[0].get('domains'),
+            'users':sum(got.get('users', 0) for got in answers), 'workers':[got['ready'] for got in answers]})
+
+    async def leaderboard(self, req:web.Request) -> web.Response:
+        """Combines the leaderboards of all workers into one"""
+        async def ask(index:int, query:dict) -> web.Response | dict:
+            async with self.workers[index].get('/leaderboard', params=query) as resp:
+                if resp.status != 200:
+                    return web.Response(status=resp.status, body=await resp.read(), content_type=resp.content_type)
+                return await codec.read(resp)
+        query = {k:v for k,v in req.query.items() if k != 'user'}
+        uid, mine, ahead = req.query.get('user'), None, []
+        if uid is not None:
+            if not (uid.isascii() and uid.isdigit()):
+                return codec.json_response(status=400, data={"error":"top and user must be integers, above a number"})
+            mine = await ask(int(uid) % len(self.workers), {'user':uid, 'top':'0'})
+            if isinstance(mine, web.Response): return mine
+            mine = mine['user']
+            # counts, on every worker, the users ahead of this one
+            ahead = await asyncio.gather(*(ask(i, {'top':'0', 'above':str(mine['points'])}) for i in range(len(self.workers))))
+        answers = await asyncio.gather(*(ask(i, query) for i in range(len(self.workers))))
+        for got in answers + ahead:
+            if isinstance(got, web.Response): return got
+        n = sum(got['users'] for got in answers)
+        k = max(0, min(int(query.get('top', 10)), 1000))
+        top = sorted((entry for got in answers for entry in got['top']), key=lambda entry: -entry['points'])[:k]
+        for i,entry in enumerate(top): # every user with more points is also in the merged list
+            entry['rank'] = i+1 if i == 0 or entry['points'] != top[i-1]['points'] else top[i-1]['rank']
+        ans = {'users':n, 'top':top}
+        if mine is not None:
+            beaten = sum(got['above'] for got in ahead)
+            ans['user'] = {**mine, 'rank':beaten+1, 'percentile':100*(n-beaten)/n}
+        if 'above' in query:
+            ans['above'] = sum(got['above'] for got in answers)
+        return codec.json_response(data=ans)
+
+    async def metrics(self) -> web.Response:
+        """Every worker's metrics, each sample labelled with the worker it came from"""
+        async def scrape(worker):
+            async with worker.get('/metrics') as resp:
+                return await resp.text()
+        families = {} # {metric name: [header lines, sample lines]}
+        for index, text in enumerate(await asyncio.gather(*(scrape(worker) for worker in self.workers))):
+            for line in text.splitlines():
+                if line.startswith('#'):
+                    name = line.split()[2]
+                    headers = families.setdefault(name, [[], []])[0]
+                    if line not in headers: headers.append(line)
+                elif line:
+                    sample, value = line.rsplit(' ', 1)
+                    if '{' in sample: sample = sample.replace('{', '{worker="%d",' % index, 1)
+                    else: sample += '{worker="%d"}' % index
+                    families[name][1].append(sample+' '+value)
+        return web.Response(body=''.join(line+'\n' for headers,samples in families.values() for line in headers+samples).encode(),
+            headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def traces(self, req:web.Request) -> web.Response:
+        """The newest span trees across all workers"""
+        answers = await asyncio.gather(*(self.relay(i, req, b'') for i in range(len(self.workers))))
+        for resp in answers:
+            if resp.status != 200: return resp
+        found = sorted((tree for resp in answers for tree in codec.loads(resp.body)), key=lambda tree: -tree['start'])
+        return codec.json_response(data=found[:int(req.query.get('limit', 50))])
+
+    async def bulk_login(self, req:web.Request, body:bytes) -> web.Response:
+        """Splits a bulk login evenly across the workers"""
+        try: count = codec.loads(body)['count']
+        except: count = None
+        if not isinstance(count, int) or isinstance(count, bool) or count <= 0:
+            return await self.relay(0, req, body)
+        n = len(self.workers)
+        shares = [(i, count//n + (i < count%n)) for i in range(n)]
+        answers = await asyncio.gather(*(self.relay(i, req, codec.dumps({'count':share})) for i,share in shares if share))
+        for resp in answers:
+            if resp.status != 200: return resp
+        return codec.json_response(data=[user for resp in answers for user in codec.loads(resp.body)])
+
+def serve_cluster(args, public_url:str) -> None:
+    """Runs a hub as a router process in front of args.workers worker processes"""
+    import multiprocessing, tempfile
+    sockets = tempfile.mkdtemp(prefix='hub-')
+    paths = [os.path.join(sockets, f'worker-{i}.sock') for i in range(args.workers)]
+    procs = [multiprocessing.Process(target=serve_worker, args=(i, args, public_url, paths[i]), daemon=True) for i in range(args.workers)]
+    for proc in procs: proc.start()
+    router = Router(paths)
+    app = web.Application()
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.stop)
+    app.router.add_route('*', '/{tail:.*}', router.route)
+    try:
+        web.run_app(app, host=args.host, port=args.port)
+    finally:
+        for proc in procs: proc.terminate()
+        for proc in procs: proc.join()
+        for path in paths:
+            if os.path.exists(path): os.remove(path)
+        os.rmdir(sockets)
+
 
 async def start_session(app):
     """To be run on startup of each event loop"""
-    from aiohttp import ClientSession, ClientTimeout
-    app.client = ClientSession(timeout=ClientTimeout(total=3))
+    app.client = ClientSession(timeout=ClientTimeout(total=3), trace_configs=[tracing.client_trace()])
+    app.links = {} # {domain_id: DomainLink}
+    app.refiller = asyncio.create_task(refill_secrets())
+    app.evictor = asyncio.create_task(evict_idle()) if idle_store is not None else None
+    if mode == 'play':
+        await open_links(app)
+    if journal is not None:
+        journal.snapshot()
 
 async def end_session(app):
     """To be run on shutdown of each event loop"""
+    app.refiller.cancel()
+    if app.evictor is not None: app.evictor.cancel()
     await app.client.close()
+    for link in app.links.values():
+        await link.close()
+    if journal is not None:
+        await journal.close()
+
+
+def configure(args, public_url:str, state:str|None, world:str|None=None) -> None:
+    """Applies command-line settings to this process, and preloads world if the state has not started play"""
+    global whoami, journey_budget, leg_timeout, domain_pool_size, snapshot_every, journal, world_out
+    global idle_ttl, max_resident, idle_store, spill
+    whoami = public_url
+    for name, rate, burst in args.rate_limit or ():
+        rate_limits[name] = (rate, burst)
+    journey_budget = args.journey_budget
+    leg_timeout = args.leg_timeout
+    domain_pool_size = args.domain_connections
+    snapshot_every = args.snapshot_every
+    world_out = args.save_world
+    if args.idle_ttl is not None:
+        idle_ttl = args.idle_ttl
+    max_resident = args.max_resident
+    if state:
+        idle_store = IdleStore(os.path.join(state, 'idle-users'))
+    elif args.idle_ttl is not None or max_resident: # removed when the process exits
+        spill = tempfile.TemporaryDirectory(prefix='hub-idle-users-')
+        idle_store = IdleStore(spill.name)
+    if state:
+        journal = Journal(state)
+        journal.restore()
+    if world and mode == 'setup':
+        preload(world)
+
+def rate_limit(text:str) -> tuple[str, float, int]:
+    """Parses a --rate-limit option"""
+    name, rate, burst = text.split(':')
+    if name not in rate_limits or float(rate) <= 0 or int(burst) < 1:
+        raise ValueError(text)
+    return name, float(rate), int(burst)
+
+def make_app() -> web.Application:
+    """The hub's web application"""
+    app = web.Application()
+    app.on_startup.append(start_session)
+    app.on_shutdown.append(end_session)
+    app.add_routes(routes)
+    tracing.setup(app)
+    metrics.setup(app)
+    return app
 
 
 if __name__ == '__main__':
@@ -566,18 +2284,30 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, default="0.0.0.0")
     parser.add_argument('-p','--port', type=int, default=10340)
+    parser.add_argument('--journey-budget', type=float, default=journey_budget, help="seconds before a journey answers without waiting for slow domains")
+    parser.add_argument('--leg-timeout', type=float, default=leg_timeout, help="seconds each /depart or /arrive call may take")
+    parser.add_argument('--domain-connections', type=int, default=domain_pool_size, help="most connections open to each domain")
+    parser.add_argument('--state', type=str, help="directory for the write-ahead log and snapshots used to recover after a crash")
+    parser.add_argument('--snapshot-every', type=int, default=snapshot_every, help="logged changes between snapshots")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes, each owning the users whose id is its index modulo this")
+    parser.add_argument('--world', type=str, help="file of domains, items, map and loot to start in play mode with, as written by --save-world")
+    parser.add_argument('--save-world', type=str, help="file to write the world to when play starts")
+    parser.add_argument('--idle-ttl', type=float, help=f"seconds a user may be inactive before being moved from memory to disk; with --state the default is {idle_ttl:g}, and without it users are only evicted if this or --max-resident is given")
+    parser.add_argument('--max-resident', type=int, default=max_resident, help="most users to keep in memory, evicting the least recently active; 0 for no limit")
+    parser.add_argument('--rate-limit', type=rate_limit, action='append', metavar='CLASS:RATE:BURST',
+        help="per-user command rate limit, e.g. travel:1:5 for one journey or drop a second in bursts of five; repeatable")
     args = parser.parse_args()
 
     import socket
-    whoami = socket.getfqdn()
-    if '.' not in whoami: whoami = 'localhost'
-    whoami += ':'+str(args.port)
-    whoami = 'http://' + whoami
-    print("URL to visit in browser:\n\t"+whoami)
+    url = socket.getfqdn()
+    if '.' not in url: url = 'localhost'
+    url += ':'+str(args.port)
+    url = 'http://' + url
+    print("URL to visit in browser:\n\t"+url)
     print()
     
-    app = web.Application()
-    app.on_startup.append(start_session)
-    app.on_shutdown.append(end_session)
-    app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+    if args.workers > 1:
+        serve_cluster(args, url)
+    else:
+        configure(args, url, args.state, args.world)
+        web.run_app(make_app(), host=args.host, port=args.port)
@@ -0,0 +1,208 @@
+"""Load generator: simulated players solving the Ossuary of the Nameless King
+
+Each player logs in to the hub and plays newdomain.py's walkthrough, sending
+hub commands to the hub's /command and the rest to the domain's /command.
+Latency is recorded per command verb and per endpoint, and a JSON report with
+throughput and p50/p95/p99 latencies is written when every player is done.
+
+    python loadgen.py --players 200 --spawn
+    python loadgen.py --players 200 --hub http://localhost:10340 --domain http://localhost:3400
+
+With --spawn, --world starts both servers from a world file written by an
+earlier hub.py --save-world run against the same ports, so they come up in
+play mode without registering.
+"""
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+import asyncio
+import json
+import re
+import subprocess
+import sys
+import time
+
+import harness
+
+
+# The walkthrough, as (command, text expected somewhere in the response).
+# "{loot}" is replaced by the id of an item another domain asked this one to host,
+# found in the response to the previous command.
+walkthrough = [
+    ('look', 'Nexus'),
+    ('take biomechtablet0', 'was taken'),
+    ('read biomechtablet0', 'OZOOZZO'),
+    ('go left', 'symbiotic lock'),
+    ('take biomechpalmr', 'was taken'),
+    ('look', None),
+    ('take {loot}', 'was taken'),
+    ('use symbioticlock 89', 'accepted'),
+    ('go back', None),
+    ('journey north', 'You travel'),
+    ('inventory', 'biomechpalml'),
+    ('go forward', 'palm scanner'),
+    ('use palmscanner', 'flashes green'),
+    ('take biomecheyer', 'was taken'),
+    ('take biomechtablet1', 'was taken'),
+    ('look', None),
+    ('take {loot}', 'was taken'),
+    ('go right', None),
+    ('use symbioticlock 21185', 'accepted'),
+    ('go back', None),
+    ('go forward', 'retinal scanners'),
+    ('use retinalscanner', 'flashes green'),
+    ('take tissuesample', 'was taken'),
+    ('take biomechtablet10', 'was taken'),
+    ('look', None),
+    ('take {loot}', 'was taken'),
+    ('use symbioticlock 303625', 'accepted'),
+    ('go forward', 'treasure room'),
+    ('use sampleanalyzer', 'vault click'),
+    ('take pendantofnk', 'was taken'),
+    ('score', 'Total'),
+    ('journey south', 'metalcranium'),
+    ('offer altar', 'accepted your offering'),
+    ('touch altar', 'sarcophagus'),
+]
+
+# Items newdomain.py hosts itself; anything else listed in a room is loot from elsewhere
+domain_item_names = {'tissuesample', 'metalcranium', 'biomecheyel', 'biomecheyer', 'biomechpalml',
+    'biomechpalmr', 'biomechtablet0', 'biomechtablet1', 'biomechtablet10', 'pendantofnk'}
+
+listed = re.compile(r'There is a (.*?) <sub>(\d+)</sub>')
+
+
+class Recorder:
+    """Latencies in seconds, by command verb and by endpoint, plus failures"""
+    def __init__(self):
+        self.commands = {} # {verb: [seconds]}
+        self.endpoints = {} # {"hub /command": [seconds]}
+        self.errors = {} # {verb or endpoint: count}
+        self.unexpected = {} # {command: count} of answers without the expected text
+
+    def record(self, verb:str, endpoint:str, took:float, ok:bool) -> None:
+        self.commands.setdefault(verb, []).append(took)
+        self.endpoints.setdefault(endpoint, []).append(took)
+        if not ok:
+            self.errors[verb] = self.errors.get(verb, 0) + 1
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed:float, players:int, finished:int) -> dict:
+        total = sum(len(v) for v in self.endpoints.values())
+        return {
+            'players':players,
+            'finished':finished,
+            'seconds':round(elapsed, 3),
+            'requests':total,
+            'throughput':round(total/elapsed, 2) if elapsed else None,
+            'errors':sum(self.errors.get(k, 0) for k in self.endpoints),
+            'unexpected':self.unexpected,
+            'commands':{k:summary(v, self.errors.get(k, 0), elapsed) for k,v in sorted(self.commands.items())},
+            'endpoints':{k:summary(v, self.errors.get(k, 0), elapsed) for k,v in sorted(self.endpoints.items())},
+        }
+
+def percentile(ordered:list[float], p:float) -> float:
+    """The nearest-rank p-th percentile of a sorted list"""
+    return ordered[max(0, min(len(ordered)-1, round(p/100*len(ordered)+0.5)-1))]
+
+def summary(took:list[float], errors:int, elapsed:float) -> dict:
+    ordered = sorted(took)
+    ms = lambda s: round(s*1000, 3)
+    return {'count':len(ordered), 'errors':errors, 'per_second':round(len(ordered)/elapsed, 2) if elapsed else None,
+        'mean_ms':ms(sum(ordered)/len(ordered)), 'p50_ms':ms(percentile(ordered, 50)),
+        'p95_ms':ms(percentile(ordered, 95)), 'p99_ms':ms(percentile(ordered, 99)), 'max_ms':ms(ordered[-1])}
+
+
+async def timed(session:ClientSession, rec:Recorder, verb:str, endpoint:str, method:str, url:str, **kwargs) -> tuple[int, str]:
+    start = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as resp:
+            text = await resp.text()
+            status = resp.status
+    except Exception as ex:
+        status, text = 0, repr(ex)
+    rec.record(verb, endpoint, time.perf_counter() - start, 0 < status < 400)
+    return status, text
+
+async def play(session:ClientSession, rec:Recorder, hub:str, domain:str|None) -> bool:
+    """One player's walkthrough; True if every step got the answer it expected"""
+    status, text = await timed(session, rec, 'login', 'hub /login', 'GET', hub+'/login')
+    if status != 200: return False
+    me = json.loads(text)
+    domain = domain or me['domain']['url']
+    loot = []
+    good = True
+    for command, expect in walkthrough:
+        if '{loot}' in command:
+            if not loot: continue # nothing hosted for this player here
+            command = command.format(loot=loot.pop(0))
+        words = command.split()
+        body = {'user':me['id'], 'command':words}
+        if words[0] in harness.hub_verbs:
+            body['secret'] = me['secret']
+            status, text = await timed(session, rec, words[0], 'hub /command', 'POST', hub+'/command', json=body)
+        else:
+            if 'token' in me['domain']: body['token'] = me['domain']['token']
+            status, text = await timed(session, rec, words[0], 'domain /command', 'POST', domain+'/command', json=body)
+        loot = [tid for name,tid in listed.findall(text) if name not in domain_item_names]
+        if status != 200 or (expect is not None and expect not in text):
+            rec.unexpected[command] = rec.unexpected.get(command, 0) + 1
+            good = False
+    return good
+
+async def prepare(session:ClientSession, hub:str, domain:str) -> None:
+    """Registers the domain and starts play, unless the hub is already in play mode"""
+    async with session.get(hub+'/mode') as resp:
+        if await resp.text() == 'play': return
+    async with session.post(hub+'/domain', data=domain) as resp:
+        print(await resp.text(), file=sys.stderr)
+    async with session.post(hub+'/mode', data='play') as resp:
+        print(await resp.text(), file=sys.stderr)
+
+async def run(args) -> dict:
+    rec = Recorder()
+    connector = TCPConnector(limit=args.connections)
+    async with ClientSession(connector=connector, timeout=ClientTimeout(total=args.timeout)) as session:
+        if args.spawn:
+            await harness.ready(session, args.hub)
+            await harness.ready(session, args.domain)
+        if args.domain:
+            await prepare(session, args.hub, args.domain)
+        async def player(i):
+            await asyncio.sleep(args.ramp * i / args.players)
+            return await play(session, rec, args.hub, args.domain)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(player(i) for i in range(args.players)))
+        elapsed = time.perf_counter() - start
+    return rec.report(elapsed, args.players, sum(results))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--players', type=int, default=50, help="simulated players, all playing at once")
+    parser.add_argument('--hub', type=str, default='http://localhost:10340', help="hub URL")
+    parser.add_argument('--domain', type=str, help="domain URL to register and play against; by default, wherever login sends each player")
+    parser.add_argument('--spawn', action='store_true', help="start hub.py and newdomain.py on the ports of --hub and --domain for the run")
+    parser.add_argument('--world', type=str, help="with --spawn, world file to start both servers from")
+    parser.add_argument('--ramp', type=float, default=0.0, help="seconds over which players start")
+    parser.add_argument('--connections', type=int, default=256, help="most connections open at once")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds any one request may take")
+    parser.add_argument('-o', '--out', type=str, help="file for the JSON report instead of standard output")
+    args = parser.parse_args()
+
+    servers = []
+    if args.spawn:
+        from urllib.parse import urlsplit
+        args.domain = args.domain or 'http://localhost:3400'
+        world = ['--world', args.world] if args.world else []
+        servers = [subprocess.Popen([sys.executable, script, '--port', str(urlsplit(url).port), *world], stdout=subprocess.DEVNULL)
+            for script,url in (('hub.py', args.hub), ('newdomain.py', args.domain))]
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        for server in servers: server.terminate()
+        for server in servers: server.wait()
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f: f.write(text+'\n')
+    else:
+        print(text)
@@ -0,0 +1,177 @@
+"""In-process counters and histograms, served at /metrics in the Prometheus text format
+
+Recording a value is a dict lookup and an addition, so it is cheap enough for
+every request; everything else happens when /metrics is scraped.
+"""
+from aiohttp import web, TraceConfig
+import asyncio
+import bisect
+import time
+
+
+class Histogram:
+    """Counts of observations falling at or below each of a fixed set of bounds"""
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds:tuple|None=None):
+        if bounds is not None: self.bounds = bounds
+        self.counts = [0]*(len(self.bounds)+1) # the last one counts everything above bounds[-1]
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        return {'count':self.count, 'sum':self.sum,
+            'buckets':dict(zip([*map(str, self.bounds), '+Inf'], self.counts))}
+
+
+counters = {} # {(name, ((label, value),...)): number}
+histograms = {} # {(name, ((label, value),...)): Histogram}
+gauges = {} # {name: function returning a number, {((label, value),...): number} or a Histogram}
+helps = {} # {name: one-line description}
+
+# Seconds between checks of how late the event loop wakes up
+lag_interval = 0.1
+
+
+def count(name:str, n:float=1, **labels) -> None:
+    key = (name, tuple(labels.items()))
+    counters[key] = counters.get(key, 0) + n
+
+def histogram(name:str, **labels) -> Histogram:
+    """The histogram for name and labels, made on first use; keep it to skip the lookup"""
+    key = (name, tuple(labels.items()))
+    found = histograms.get(key)
+    if found is None:
+        found = histograms[key] = Histogram()
+    return found
+
+def gauge(name:str, help:str):
+    """Decorator registering a function to be called for the value of name on each scrape"""
+    def register(fn):
+        gauges[name] = fn
+        helps[name] = help
+        return fn
+    return register
+
+def describe(name:str, help:str) -> None:
+    helps[name] = help
+
+
+def client_timing(name:str, **labels) -> TraceConfig:
+    """Times every request of a ClientSession, by path, into histogram name
+
+    Requests that fail to get a response are counted in name_failures_total.
+    """
+    trace = TraceConfig()
+    async def start(session, ctx, params):
+        ctx.start = time.perf_counter()
+    async def end(session, ctx, params):
+        histogram(name, **labels, path=params.url.path).observe(time.perf_counter() - ctx.start)
+    async def fail(session, ctx, params):
+        count(name+'_failures_total', **labels, path=params.url.path)
+    trace.on_request_start.append(start)
+    trace.on_request_end.append(end)
+    trace.on_request_exception.append(fail)
+    return trace
+
+
+@web.middleware
+async def middleware(req:web.Request, handler) -> web.StreamResponse:
+    """Counts and times every request by method, route and status"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(req)
+        status = resp.status
+        return resp
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        resource = req.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        histogram('http_request_seconds', method=req.method, route=route).observe(time.perf_counter() - start)
+        count('http_requests_total', method=req.method, route=route, status=status)
+
+async def watch_lag(app:web.Application) -> None:
+    """Records how much later than asked the event loop wakes from a sleep"""
+    lag = histogram('event_loop_lag_seconds')
+    loop = asyncio.get_running_loop()
+    while True:
+        asked = loop.time() + lag_interval
+        await asyncio.sleep(lag_interval)
+        lag.observe(max(0.0, loop.time() - asked))
+
+
+def escape(value) -> str:
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def labelled(labels:tuple, extra:str='') -> str:
+    inner = ','.join(f'{k}="{escape(v)}"' for k,v in labels)
+    if extra: inner = inner+','+extra if inner else extra
+    return '{'+inner+'}' if inner else ''
+
+def render_histogram(lines:list, name:str, labels:tuple, h:Histogram) -> None:
+    total = 0
+    for bound,n in zip([*map(str, h.bounds), '+Inf'], h.counts):
+        total += n
+        le = 'le="%s"' % bound
+        lines.append(f'{name}_bucket{labelled(labels, le)} {total}')
+    lines.append(f'{name}_sum{labelled(labels)} {h.sum}')
+    lines.append(f'{name}_count{labelled(labels)} {h.count}')
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    def header(name, kind):
+        if name in helps: lines.append(f'# HELP {name} {helps[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name, series in by_name.items():
+        header(name, 'counter')
+        lines.extend(f'{name}{labelled(labels)} {value}' for labels, value in series)
+    by_name = {}
+    for (name, labels), h in histograms.items():
+        by_name.setdefault(name, []).append((labels, h))
+    for name, series in by_name.items():
+        header(name, 'histogram')
+        for labels, h in series: render_histogram(lines, name, labels, h)
+    for name, fn in gauges.items():
+        value = fn()
+        if isinstance(value, Histogram):
+            header(name, 'histogram')
+            render_histogram(lines, name, (), value)
+            continue
+        header(name, 'gauge')
+        if isinstance(value, dict):
+            lines.extend(f'{name}{labelled(labels)} {v}' for labels, v in value.items())
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines)+'\n'
+
+async def serve(req:web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def setup(app:web.Application) -> None:
+    """Adds request metrics, event loop lag and a GET /metrics route to an app that is not yet running"""
+    app.middlewares.append(middleware)
+    app.router.add_get('/metrics', serve)
+    async def start(app):
+        app.lag_watcher = asyncio.create_task(watch_lag(app))
+    async def stop(app):
+        app.lag_watcher.cancel()
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+
+
+describe('http_request_seconds', 'Time to handle a request, by route')
+describe('http_requests_total', 'Requests handled, by route and status')
+describe('event_loop_lag_seconds', 'How late the event loop ran a timer')
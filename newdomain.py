@@ -1,7 +1,16 @@
 from aiohttp import web
-from aiohttp.web import Request, Response, json_response
+from aiohttp.web import Request, Response
+import base64
+import hashlib
+import hmac
 import random
 import copy
+import time
+
+import codec
+from codec import json_response
+import metrics
+import tracing
 
 routes = web.RouteTableDef()
 
@@ -10,8 +19,13 @@ base_domain_info = {
     "hub_url": "",
     "domain_id": None,
     "secret": None,
+    "key": None,  # verifies the session tokens the hub issues for this domain
+    "codec": codec.JSON,  # Content-Type for bodies sent to the hub, negotiated at registration
 }
 
+# Reject /command requests that carry no session token (--require-token); by default they are trusted, as before
+require_token = False
+
 base_domain_state = {
     "item_ids": {},  # ItemID : Item Description, this is for all items hosted by this domain
     "item_names": {},  # Name: ItemID
@@ -184,17 +198,26 @@ async def register_with_hub_server(req: Request) -> Response:
             "name": "Ossuary of the Nameless King",
             "description": "A biomechanical church, dedicated to the revered Nameless King",
             "items": domain_items,
+            "codecs": codec.available,
         },
     ) as resp:
-        data = await resp.json()
+        data = await codec.read(resp)
         if "error" in data:
             return json_response(status=resp.status, data=data)
 
+    registered(url, data)
+    return json_response(data={"ok": "Domain registered successfully"})
+
+
+def registered(hub_url, data):
+    """Stores what the hub's /register answered, and resets the domain for play"""
     # TO DO: store the url and values in the returned data for later use
     # Store hub information
-    base_domain_info["hub_url"] = url
+    base_domain_info["hub_url"] = hub_url
     base_domain_info["domain_id"] = data["id"]
     base_domain_info["secret"] = data["secret"]
+    base_domain_info["key"] = bytes.fromhex(data["key"]) if "key" in data else None
+    base_domain_info["codec"] = codec.pick(data.get("codecs", ()))
 
     # TO DO: clear any user/game state to its initial state
     users.clear()
@@ -228,18 +251,39 @@ async def register_with_hub_server(req: Request) -> Response:
         base_domain_state["locations"][cur_location]["items_id"].append(cur_id)
         base_domain_state["locations"][cur_location]["items_name"].append(cur_name)
 
-    return json_response(data={"ok": "Domain registered successfully"})
-
 
 @routes.post("/arrive")
 async def register_with_hub_server(req: Request) -> Response:
     """Called by hub server each time a user enters or re-enters this domain."""
-    data = await req.json()
+    data = await codec.read(req)
+
+    # Verify secret matches
+    if data["secret"] != base_domain_info["secret"]:
+        return json_response(status=403, data={"error": "Invalid secret"})
+
+    return codec.respond(req, {"unused_items_depth": arrive_user(data)})
+
+
+@routes.post("/arrive_batch")
+async def register_with_hub_server(req: Request) -> Response:
+    """Called by hub server with many arrivals at once, such as during a bulk login.
+
+    The payload is {"secret": ..., "arrivals": [an /arrive payload without its secret, ...]}
+    """
+    data = await codec.read(req)
 
     # Verify secret matches
     if data["secret"] != base_domain_info["secret"]:
         return json_response(status=403, data={"error": "Invalid secret"})
 
+    return codec.respond(
+        req,
+        {"arrived": [{"user": arrival["user"], "unused_items_depth": arrive_user(arrival)} for arrival in data["arrivals"]]},
+    )
+
+
+def arrive_user(data):
+    """Sets up or resets the state of one arriving user; returns the prize items that could not be placed"""
     user_id = data["user"]
     user_state = None
     user_domain_state = None
@@ -368,12 +412,12 @@ async def register_with_hub_server(req: Request) -> Response:
             unused_depth.append(item)
 
     user_domain_state["user_state"] = user_state
-    return json_response(status=200, data={"unused_items_depth": unused_depth})
+    return unused_depth
 
 
 @routes.post("/depart")
 async def register_with_hub_server(req: Request) -> Response:
-    data = await req.json()
+    data = await codec.read(req)
 
     user_id = data["user"]
     if user_id not in users:
@@ -397,7 +441,7 @@ async def register_with_hub_server(req: Request) -> Response:
     """Called by hub server each time a user drops an item in this domain.
     The return value must be JSON, and will be given as the location on subsequent /arrive calls
     """
-    data = await req.json()
+    data = await codec.read(req)
 
     # Verify secret matches
     if data["secret"] != base_domain_info["secret"]:
@@ -453,7 +497,22 @@ async def register_with_hub_server(req: Request) -> Response:
     user_domain_state["locations"][location]["items_name"].append(item["name"])
 
     # Return the location where item was dropped
-    return json_response(location)
+    return codec.respond(req, location)
+
+def token_user(token):
+    """Checks a hub-issued session token locally, returning its user id, or None if it is forged or expired"""
+    key = base_domain_info["key"]
+    try:
+        user_id, expiry, mac = token.split(".")
+        good = hmac.digest(key, f"{user_id}.{expiry}".encode(), hashlib.sha256)
+        if not hmac.compare_digest(base64.urlsafe_b64encode(good).rstrip(b"=").decode(), mac):
+            return None
+        if int(expiry) < time.time():
+            return None
+        return int(user_id)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
 
 def find_item_location(user_id, item_query):
     user_domain_state = users[user_id]
@@ -489,10 +548,13 @@ def find_item_location(user_id, item_query):
 @routes.post("/command")
 async def handle_command(req: Request) -> Response:
     """Handle hub-server commands"""
-    data = await req.json()
+    data = await codec.read(req)
 
     # Get user state
     user_id = data["user"]
+    if "token" in data or require_token:
+        if token_user(data.get("token")) != user_id:
+            return json_response(status=403, data={"error": "Invalid or expired token"})
     if user_id not in users:
         return Response(
             text="You have to journey to this domain before you can send it commands."
@@ -700,7 +762,9 @@ async def handle_command(req: Request) -> Response:
 
                 # Call transfer endpoint
                 async with req.app.client.post(
-                    base_domain_info["hub_url"] + "/transfer", json=transfer_data
+                    base_domain_info["hub_url"] + "/transfer",
+                    data=codec.encode(transfer_data, base_domain_info["codec"]),
+                    headers=codec.headers(base_domain_info["codec"]),
                 ) as resp:
                     if resp.status == 200:
                         # Remove item from location lists
@@ -893,9 +957,11 @@ async def handle_command(req: Request) -> Response:
 
                     # Call transfer endpoint
                     async with req.app.client.post(
-                        base_domain_info["hub_url"] + "/score", json=score_data
+                        base_domain_info["hub_url"] + "/score",
+                        data=codec.encode(score_data, base_domain_info["codec"]),
+                        headers=codec.headers(base_domain_info["codec"]),
                     ) as resp:
-                        info = await resp.json()
+                        info = await codec.read(resp)
                     return Response(text= "The sample analyzer flashes green. You hear the vault click in the background.")
                 else:
                     return Response(text= "You are missing the tissue sample or the metal cranium.")
@@ -973,6 +1039,87 @@ async def handle_command(req: Request) -> Response:
     return Response(text="I don't know how to do that.")
 
 
+@routes.get("/healthz")
+async def healthz(req: Request) -> Response:
+    """Liveness probe: answers whenever the server is accepting requests"""
+    return Response(text="ok")
+
+
+@routes.get("/readyz")
+async def readyz(req: Request) -> Response:
+    """Readiness probe: startup has finished by the time this answers; also says whether a hub has registered this domain"""
+    return json_response(data={"ready": True, "registered": base_domain_info["domain_id"] is not None})
+
+
+@metrics.gauge("domain_users", "Users who have visited this domain, by whether they are here now")
+def users_present():
+    here = sum(1 for state in users.values() if state["user_state"]["arrived"])
+    return {(("present", "yes"),): here, (("present", "no"),): len(users) - here}
+
+
+@metrics.gauge("domain_inventory_items", "Items each user here carries, as far as this domain knows")
+def inventory_sizes():
+    sizes = metrics.Histogram((0, 1, 2, 3, 5, 10, 20, 50, 100))
+    for state in users.values():
+        if state["user_state"]["arrived"]:
+            items = state["user_state"]["items_id"]
+            sizes.observe(len(items["owned"]) + len(items["carried"]))
+    return sizes
+
+
+metrics.describe("domain_hub_call_seconds", "Time for the hub to answer a call from this domain, by path")
+metrics.describe("domain_hub_call_seconds_failures_total", "Calls to the hub that got no answer")
+
+
+def preload(path):
+    """Registers from a world file the hub was also started with (see the hub's --world), instead of calling /register"""
+    import json
+
+    try:
+        with open(path) as f:
+            world = json.load(f)
+        for entry in world["domains"]:
+            if entry["url"] == whoami:
+                ids = {item["name"]: item["id"] for item in entry["items"]}
+                missing = [item["name"] for item in domain_items if item["name"] not in ids]
+                if missing:
+                    raise SystemExit(f"Bad world file {path}: the domain at {whoami} lacks items {', '.join(missing)}")
+                registered(world["hub"]["url"], {
+                    "id": entry["id"],
+                    "secret": entry["secret"],
+                    "key": entry["key"],
+                    "items": [ids[item["name"]] for item in domain_items],
+                    "codecs": world["hub"].get("codecs", []),
+                })
+                return
+    except (OSError, ValueError) as ex:
+        raise SystemExit(f"Cannot read world file {path}: {ex}")
+    except (KeyError, TypeError, AttributeError) as ex:
+        raise SystemExit(f"Bad world file {path}: missing or malformed {ex}")
+    raise SystemExit(f"{path} has no domain at {whoami}")
+
+
+async def open_client(app):
+    """Makes the singleton ClientSession, timing and tracing each call to the hub; replaces start_session below"""
+    from aiohttp import ClientSession, ClientTimeout
+
+    app.client = ClientSession(
+        timeout=ClientTimeout(total=3),
+        trace_configs=[metrics.client_timing("domain_hub_call_seconds"), tracing.client_trace()],
+    )
+
+
+def make_app():
+    """The domain's web application; allow_cors and end_session are defined below"""
+    app = web.Application(middlewares=[allow_cors])
+    app.on_startup.append(open_client)
+    app.on_shutdown.append(end_session)
+    app.add_routes(routes)
+    tracing.setup(app)
+    metrics.setup(app)
+    return app
+
+
 # Do not modify code below this line
 
 
@@ -1004,7 +1151,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="0.0.0.0")
     parser.add_argument("-p", "--port", type=int, default=3400)
+    parser.add_argument("--world", type=str, help="world file the hub was started with, to skip registering")
+    parser.add_argument("--require-token", action="store_true", help="reject /command requests without a valid session token")
     args = parser.parse_args()
+    require_token = args.require_token
 
     import socket
 
@@ -1015,9 +1165,7 @@ if __name__ == "__main__":
     whoami = "http://" + whoami
     print("URL to type into web prompt:\n\t" + whoami)
     print()
+    if args.world:
+        preload(args.world)
 
-    app = web.Application(middlewares=[allow_cors])
-    app.on_startup.append(start_session)
-    app.on_shutdown.append(end_session)
-    app.add_routes(routes)
-    web.run_app(app, host=args.host, port=args.port)
+    web.run_app(make_app(), host=args.host, port=args.port)
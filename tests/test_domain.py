@@ -1,10 +1,12 @@
-import subprocess, signal, json, random, sys, time
+import importlib, json, os, pickle, random, sys, time
 import urllib.request
 import pytest
 import asyncio
 import aiohttp
 import re
 
+import harness
+
 
     # foyer description
 s1 = "You're in a hallway, unless it is a waiting room, or maybe a foyer? There are a couple of benches along the wall. To the east is an abandoned eatery of some kind blocked off by a grid of metal bars. To the north is a pair of double doors with a sign. To the east are double doors through which you can see indirect sunshine."
@@ -80,48 +82,29 @@ s26 = "You have to journey to this domain before you can send it commands."
 r5 = re.compile(r'There is a (.*?) <sub>(.*?)</sub> here.')
 
 
-class sessionwrapper:
-  def __init__(self):
-    self.p = random.randrange(1<<14, 1<<16)
-  def __enter__(self):
-    self.hub = subprocess.Popen([sys.executable, "hub.py", '--port', str(self.p)])
-    self.dom = subprocess.Popen([sys.executable, "domain.py", '--port', str(self.p+1)])
-    time.sleep(0.5)
-    return self.p, self.p+1
-  def __exit__(self, extype, exval, extb):
-    self.hub.send_signal(signal.Signals.SIGINT)
-    self.dom.send_signal(signal.Signals.SIGINT)
-    time.sleep(0.1)
-    self.hub.terminate()
-    self.dom.terminate()
-
 class playwrapper:
-  def __init__(self):
-    self.sw = sessionwrapper()
-  def __enter__(self):
-    self.h, self.d = self.sw.__enter__()
-    status, data = send_recv(self.h, '/domain', f"http://localhost:{self.d}")
-    assert status == 200, "hub's /domain to domain's /register"
-    status, data = send_recv(self.h, '/mode', 'play')
-    assert status == 200, "hub's /mode"
-    status, data = send_recv(self.h, '/login', '', method='GET')
-    assert status == 200, "hub's /login to domain's first /arrive"
-    assert isinstance(data, dict), "/arrive response type"
-    for key in 'domain','id','secret':
-      assert key in data, f"/arrive set of keys ({key})"
+  """A hub and domain.py running in this process, with the domain registered and one user logged in"""
+  async def __aenter__(self):
+    self.game = harness.InProcess('domain')
+    await self.game.__aenter__()
+    try:
+      await self.game.play()
+      data = await self.game.login()
+      assert isinstance(data, dict), "/arrive response type"
+      for key in 'domain','id','secret':
+        assert key in data, f"/arrive set of keys ({key})"
+    except BaseException:
+      await self.game.__aexit__(None, None, None)
+      raise
+    self.me = data
     self.id = data['id']
     self.secret = data['secret']
     self.domain = data['domain']
     return self
-  def command(self, *words):
-    if words[0] in ['drop','inventory','journey']:
-      status, data = send_recv(self.h, '/command', {'user':self.id, 'secret':self.secret, 'command':words})
-    else:
-      status, data = send_recv(self.d, '/command', {'user':self.id, 'command':words})
-    return data
-  def __exit__(self, extype, exval, extb):
-    self.sw.__exit__(extype, exval, extb)
-    
+  async def command(self, *words):
+    return await self.game.command(self.me, *words)
+  async def __aexit__(self, extype, exval, extb):
+    await self.game.__aexit__(extype, exval, extb)
 
 
 def send_recv(port, path, data, method='POST'):
@@ -135,101 +118,138 @@ def send_recv(port, path, data, method='POST'):
   try: return status, json.loads(data)
   except: return status, data
 
-def test_register(aiohttp_client):
-  with sessionwrapper() as (h,d):
-    status, data = send_recv(h, '/domain', f"http://localhost:{d}")
+async def test_register(aiohttp_client):
+  async with harness.InProcess('domain') as game:
+    status, data = await game.post(game.hub_url+'/domain', game.domain_url)
     assert status == 200
-    status, data = send_recv(h, '/mode', 'play')
+    status, data = await game.post(game.hub_url+'/mode', 'play')
     assert status == 200
     assert data == 'Now in play mode'
 
-def test_login(aiohttp_client):
-  with playwrapper() as c:
+def test_ready(aiohttp_client):
+  with harness.Subprocesses('domain.py') as (h,d):
+    assert send_recv(h, '/healthz', '', method='GET') == (200, 'ok')
+    assert send_recv(d, '/healthz', '', method='GET') == (200, 'ok')
+    status, data = send_recv(h, '/readyz', '', method='GET')
+    assert status == 200 and data['ready'] and data['mode'] == 'setup'
+    status, data = send_recv(d, '/readyz', '', method='GET')
+    assert status == 200 and data == {'ready': True, 'registered': False}
+    send_recv(h, '/domain', f"http://localhost:{d}")
+    status, data = send_recv(d, '/readyz', '', method='GET')
+    assert data['registered']
+
+async def test_harness(aiohttp_client):
+  for _ in range(2): # each run starts from fresh module state
+    async with harness.InProcess('newdomain') as game:
+      assert game.hub.mode == 'setup' and not game.hub.users
+      await game.play()
+      me = await game.login()
+      assert me['id'] == 0 and me['domain']['url'] == game.domain_url
+      assert 'Nexus' in await game.command(me, 'look')
+      assert await game.command(me, 'inventory') == 'You are not carrying anything.'
+    assert game.client.closed
+
+async def test_not_modified(aiohttp_client):
+  async with harness.InProcess('domain') as game:
+    for path in '/', '/mode':
+      async with game.client.get(game.hub_url+path) as resp:
+        etag = resp.headers['ETag']
+      async with game.client.get(game.hub_url+path, headers={'If-None-Match':etag}) as resp:
+        assert resp.status == 304
+    version = etag.strip('"')
+    for wait in 'nan', 'inf', '-1', 'soon':
+      async with game.client.get(game.hub_url+'/mode', params={'version':version, 'wait':wait}) as resp:
+        assert resp.status == 400, wait
+    async with game.client.get(game.hub_url+'/mode', params={'version':version, 'wait':'0.01'}) as resp:
+      assert resp.status == 304
+
+async def test_login(aiohttp_client):
+  async with playwrapper() as c:
     assert c.domain['name'] == 'MP10'
     assert c.domain['description'] == 'An example domain based in Siebel 1404 and its surroundings.'
 
-def test_map(aiohttp_client):
-  with playwrapper() as c:
-    f1 = c.command('look')
+async def test_map(aiohttp_client):
+  async with playwrapper() as c:
+    f1 = await c.command('look')
     assert s1 in f1
     assert len(f1) < len(s1) + 100
 
-    c1 = c.command('go','north')
+    c1 = await c.command('go','north')
     assert s3 in c1
     assert len(c1) < len(s3) + 100
 
-    p1 = c.command('go','down')
+    p1 = await c.command('go','down')
     assert s4 in p1
     assert len(p1) < len(s4) + 100
     
-    c.command('go','up')
-    c2 = c.command('look')
+    await c.command('go','up')
+    c2 = await c.command('look')
     assert s3 in c2
     assert len(c2) < len(s3) + 100
 
-    c.command('go','west')
-    p2 = c.command('look')
+    await c.command('go','west')
+    p2 = await c.command('look')
     assert s4 in p2
     assert len(p2) < len(s4) + 100
 
-    assert s24 == c.command('go','south')
-    assert p2 == c.command('look')
+    assert s24 == await c.command('go','south')
+    assert p2 == await c.command('look')
 
-    c.command('go','east')
-    c3 = c.command('look')
+    await c.command('go','east')
+    c3 = await c.command('look')
     assert c2 == c3
 
-    c.command('go','south')
-    f2 = c.command('look')
+    await c.command('go','south')
+    f2 = await c.command('look')
     assert f1 == f2
 
-def test_foyer_sign(aiohttp_client):
-  with playwrapper() as c:
-    assert s2 == c.command('read','sign')
+async def test_foyer_sign(aiohttp_client):
+  async with playwrapper() as c:
+    assert s2 == await c.command('read','sign')
 
-def test_see_paper(aiohttp_client):
-  with playwrapper() as c:
-    f1 = c.command('look')
+async def test_see_paper(aiohttp_client):
+  async with playwrapper() as c:
+    f1 = await c.command('look')
     m = r5.search(f1)
     assert m is not None, "Paper visible in starting location"
     
     assert m.group(1) == 'paper'
     pid = int(m.group(2))
     
-def test_use_paper(aiohttp_client):
-  with playwrapper() as c:
-    f1 = c.command('look')
+async def test_use_paper(aiohttp_client):
+  async with playwrapper() as c:
+    f1 = await c.command('look')
     m = r5.search(f1)
     assert m is not None, "Paper visible in starting location"
     
     assert m.group(1) == 'paper'
     pid = int(m.group(2))
     
-    c.command('take','paper')
-    msg = c.command('read','paper')
+    await c.command('take','paper')
+    msg = await c.command('read','paper')
     assert msg == 'The paper reads <q>XYZZY</q>'
     
-    f1 = c.command('look')
+    f1 = await c.command('look')
     m = r5.search(f1)
     assert m is None, "Paper gone after being taken"
     
-    c.command('go', 'north')
-    c.command('drop','paper')
-    c.command('go', 'south')
-    msg = c.command('read','paper')
+    await c.command('go', 'north')
+    await c.command('drop','paper')
+    await c.command('go', 'south')
+    msg = await c.command('read','paper')
     assert msg == s25, "can't read after dropping"
 
-    f1 = c.command('look')
+    f1 = await c.command('look')
     m = r5.search(f1)
     assert m is None, "Paper gone after being dropped elsewhere"
 
-    c.command('go', 'north')
-    c1 = c.command('look')
+    await c.command('go', 'north')
+    c1 = await c.command('look')
     assert 'There is a paper' in c1, 'Paper found where dropped'
 
-def test_hosted_item(aiohttp_client):
-  with playwrapper() as c:
-    c1 = c.command('go','north')
+async def test_hosted_item(aiohttp_client):
+  async with playwrapper() as c:
+    c1 = await c.command('go','north')
     m = r5.search(c1)
     print("m :" + str(m))
     assert m is not None, "depth=0 item in classroom"
@@ -240,101 +260,521 @@ def test_hosted_item(aiohttp_client):
     print("value of other: " + other)
 
     print("value of r4: " + str(r4))
-    print(c.command('take', other))
-    m2 = r4.fullmatch(c.command('take', other))
+    print(await c.command('take', other))
+    m2 = r4.fullmatch(await c.command('take', other))
     print("value of m2: " + str(m2))
     assert m2 is not None, "recognize the other item is not there"
     assert m2.group(1) == other, "recognize the other item is not there"
 
-    assert m.group(1) not in c.command('inventory')
-    c1 = c.command('take',m.group(1))
-    assert m.group(1) in c.command('inventory')
+    assert m.group(1) not in await c.command('inventory')
+    c1 = await c.command('take',m.group(1))
+    assert m.group(1) in await c.command('inventory')
     
     if 'axe' == m.group(1):
-      assert c.command('look','axe') == "An axe, colored like those used by firefighters to break through burning walls."
-      assert c.command('use','axe') == "An axe like this could do some serious damage. Best not to use it anywhere on campus."
+      assert await c.command('look','axe') == "An axe, colored like those used by firefighters to break through burning walls."
+      assert await c.command('use','axe') == "An axe like this could do some serious damage. Best not to use it anywhere on campus."
     else:
-      assert c.command('look','i-card') == "A University ID card. The name is smudged, but you recognize the face; this is the person who came from IT to fix the classroom computer when it broke down."
-      assert c.command('read','i-card') == "The text is smudged and you don't know how to read bar codes or magnetic stripes."
+      assert await c.command('look','i-card') == "A University ID card. The name is smudged, but you recognize the face; this is the person who came from IT to fix the classroom computer when it broke down."
+      assert await c.command('read','i-card') == "The text is smudged and you don't know how to read bar codes or magnetic stripes."
     
-    assert 'key' not in c.command('inventory')
-    c.command('go','south')
-    assert '$journey east' == c.command('go','east')
-    c.command('journey','east')
-    assert 'key' in c.command('inventory')
+    assert 'key' not in await c.command('inventory')
+    await c.command('go','south')
+    assert '$journey east' == await c.command('go','east')
+    await c.command('journey','east')
+    assert 'key' in await c.command('inventory')
     
-def test_missing_key(aiohttp_client):
-  with playwrapper() as c:
-    c.command('take','paper')
-    c.command('go','north')
-    c.command('take','axe')
-    c.command('take','i-card')
-    c.command('go', 'down')
-    assert c.command('look', 'cabinet') == s14
-    assert c.command('look', 'screen') == s6
-    assert c.command('tell', 'screen', 'xyzzy') == s25
+async def test_missing_key(aiohttp_client):
+  async with playwrapper() as c:
+    await c.command('take','paper')
+    await c.command('go','north')
+    await c.command('take','axe')
+    await c.command('take','i-card')
+    await c.command('go', 'down')
+    assert await c.command('look', 'cabinet') == s14
+    assert await c.command('look', 'screen') == s6
+    assert await c.command('tell', 'screen', 'xyzzy') == s25
     #error
-    assert c.command('look', 'switch') == s25
-    assert c.command('use', 'switch') == s25
-    assert c.command('open', 'cabinet') == s9
-    assert c.command('close', 'cabinet') == s13
-    assert c.command('use', 'key', 'cabinet') == s18
+    assert await c.command('look', 'switch') == s25
+    assert await c.command('use', 'switch') == s25
+    assert await c.command('open', 'cabinet') == s9
+    assert await c.command('close', 'cabinet') == s13
+    assert await c.command('use', 'key', 'cabinet') == s18
     
-def test_with_key_1(aiohttp_client):
-  with playwrapper() as c:
-    c.command('go','north')
-    c.command('take','axe')
-    c.command('take','i-card')
-    c.command('go','south')
-    c.command('go','east')
-    c.command('journey','east')
-    c.command('go','north')
-    c.command('go', 'west')
-    assert c.command('use', 'key', 'cabinet') == s16
-    assert c.command('use', 'key', 'cabinet') == s17
-    assert c.command('open', 'cabinet') == s9
-    assert c.command('use', 'key', 'cabinet') == s16
-    oc = c.command('open', 'cabinet')
+async def test_with_key_1(aiohttp_client):
+  async with playwrapper() as c:
+    await c.command('go','north')
+    await c.command('take','axe')
+    await c.command('take','i-card')
+    await c.command('go','south')
+    await c.command('go','east')
+    await c.command('journey','east')
+    await c.command('go','north')
+    await c.command('go', 'west')
+    assert await c.command('use', 'key', 'cabinet') == s16
+    assert await c.command('use', 'key', 'cabinet') == s17
+    assert await c.command('open', 'cabinet') == s9
+    assert await c.command('use', 'key', 'cabinet') == s16
+    oc = await c.command('open', 'cabinet')
     assert oc.startswith(s10 + '\n' + s5), "open shows success and inside of cabinet"
     print(oc)
     m = r2.search(oc)
     assert m is not None, "hosted depth=1 item"
     assert m.group(1) == 'toy', 'expected item name'
-    lp = c.command('look')
+    lp = await c.command('look')
     assert s5 in lp, "look sees inside of cabinet"
     m = r2.search(lp)
     if not m: m = r5.search(lp)
     assert m is not None, "look shows items inside cabinet"
     print(lp)
-    temp = c.command('take', 'toy')
+    temp = await c.command('take', 'toy')
     print(temp)
-    lp = c.command('look')
+    lp = await c.command('look')
     print(lp)
     assert r2.search(lp) is None and r5.search(lp) is None, "can take items from inside open cabinet"
     
     
-def test_with_key_2(aiohttp_client):
-  with playwrapper() as c:
-    c.command('go','north')
-    c.command('take','axe')
-    c.command('take','i-card')
-    c.command('go','south')
-    c.command('go','east')
-    c.command('journey','east')
-    c.command('go','north')
-    c.command('go', 'west')
-    c.command('use', 'key', 'cabinet')
-    c.command('open', 'cabinet')
-    assert c.command('look', 'switch') == s22, "look switch down"
-    assert c.command('use', 'switch') == s19, "use switch down -> up"
-    assert c.command('look', 'switch') == s21, "look switch up"
-    assert c.command('use', 'switch') == s20, "use switch up -> down"
-    assert c.command('look', 'switch') == s22, "look switch down again"
-    assert c.command('use', 'switch') == s19, "use switch down -> up again"
-    assert c.command('look', 'screen') == s7, "password screen"
-    pw = c.command('tell', 'screen', 'swordfish')
+async def test_with_key_2(aiohttp_client):
+  async with playwrapper() as c:
+    await c.command('go','north')
+    await c.command('take','axe')
+    await c.command('take','i-card')
+    await c.command('go','south')
+    await c.command('go','east')
+    await c.command('journey','east')
+    await c.command('go','north')
+    await c.command('go', 'west')
+    await c.command('use', 'key', 'cabinet')
+    await c.command('open', 'cabinet')
+    assert await c.command('look', 'switch') == s22, "look switch down"
+    assert await c.command('use', 'switch') == s19, "use switch down -> up"
+    assert await c.command('look', 'switch') == s21, "look switch up"
+    assert await c.command('use', 'switch') == s20, "use switch up -> down"
+    assert await c.command('look', 'switch') == s22, "look switch down again"
+    assert await c.command('use', 'switch') == s19, "use switch down -> up again"
+    assert await c.command('look', 'screen') == s7, "password screen"
+    pw = await c.command('tell', 'screen', 'swordfish')
     assert r1.fullmatch(pw) is not None, "bad password attempt"
     assert r1.fullmatch(pw).group(1) == 'swordfish', "bad password attempt"
-    assert c.command('look', 'screen') == s7, "password screen after bad password"
-    assert c.command('tell', 'screen', 'xyzzy') == s23, "good password attempt"
-    assert c.command('look', 'screen') == s8, "look win screen"
+    assert await c.command('look', 'screen') == s7, "password screen after bad password"
+    assert await c.command('tell', 'screen', 'xyzzy') == s23, "good password attempt"
+    assert await c.command('look', 'screen') == s8, "look win screen"
+
+
+async def test_drop_by_id(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    await game.play()
+    me = await game.login()
+    assert await game.command(me, 'drop', '\u00b2') == 'You have no \u00b2 to drop'
+    taken = await game.command(me, 'take', 'biomechtablet0')
+    tid = re.search(r'<sub>(\d+)</sub>', await game.command(me, 'inventory')).group(1)
+    assert 'dropped' in await game.command(me, 'drop', tid), taken
+
+async def test_bulk_login(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    await game.play()
+    status, answer = await game.post(game.hub_url+'/login', {'count':3})
+    assert status == 200 and len(answer) == 3
+    assert not any('arrived' in me for me in answer)
+    for here in game.hub.domains.values(): here['secret'] = 'wrong'
+    status, answer = await game.post(game.hub_url+'/login', {'count':2})
+    assert status == 200 and [me['arrived'] for me in answer] == [False, False]
+
+async def test_journal_restore(aiohttp_client, tmp_path, capsys):
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    await game.play()
+    hub.journal = hub.Journal(str(tmp_path))
+    hub.journal.snapshot()
+    first = await game.login()
+    await game.command(first, 'take', 'biomechtablet0')
+    await hub.journal.idle()
+    hub.journal.snapshot() # a second generation, so the first is pruned
+    await hub.journal.idle()
+    second = await game.login()
+    await game.command(second, 'go', 'left')
+    await game.command(second, 'take', 'biomechpalmr')
+    await asyncio.sleep(0) # the log is flushed once per event-loop pass
+    assert hub.journal.generations('snapshot') == hub.journal.generations('wal') == [2]
+    before = {uid:dict(me) for uid,me in hub.users.items()}
+    await hub.journal.close()
+  assert before[first['id']]['where']['inventory'] and before[second['id']]['where']['inventory']
+
+  hub = harness.fresh('hub')
+  hub.Journal(str(tmp_path)).restore()
+  assert hub.users == before and hub.mode == 'play'
+
+  with open(tmp_path/'wal-00000002', 'ab') as f:
+    f.write(b'\x80\x05\x95') # torn write of one more entry
+  hub = harness.fresh('hub')
+  hub.Journal(str(tmp_path)).restore()
+  assert hub.users == before
+  assert 'ends with a partial entry' in capsys.readouterr().out
+
+async def test_session_tokens(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    hub, domain = game.hub, game.domain
+    await game.play()
+    did = next(iter(hub.domains))
+    token = hub.sign(7, hub.domain_key(did))
+    assert hub.verify(token, hub.domain_key(did)) == domain.token_user(token) == 7
+    uid, expiry, mac = token.split('.')
+    assert domain.token_user(f'8.{expiry}.{mac}') is None, "tampered user"
+    assert domain.token_user(f'{uid}.{int(expiry)+1}.{mac}') is None, "tampered expiry"
+    assert domain.token_user(hub.sign(7, hub.domain_key(did+1))) is None, "another domain's key"
+    assert hub.verify('7.1.x', hub.domain_key(did)) is None and domain.token_user(None) is None
+    assert hub.verify('1.2.\u00e9', hub.token_key) is None and domain.token_user('1.2.\u00e9') is None, "non-ASCII mac"
+
+    me = await game.login()
+    domain.require_token = True
+    assert 'Nexus' in await game.command(me, 'look')
+    status, answer = await game.post(me['domain']['url']+'/command', {'user':me['id'], 'command':['look']})
+    assert status == 403
+    status, answer = await game.post(game.hub_url+'/command', {'user':me['id'], 'token':'1.2.\u00e9', 'command':['score']})
+    assert status == 403
+    async with game.client.get(game.hub_url+'/events', params={'user':str(me['id']), 'token':'1.2.\u00e9'}) as resp:
+      assert resp.status == 403
+    status, answer = await game.post(me['domain']['url']+'/command', {'user':me['id'], 'command':['look'],
+      'token':hub.sign(me['id']+1, hub.domain_key(did))})
+    assert status == 403
+
+async def test_events(aiohttp_client):
+  import metrics
+  async def read(resp, n):
+    events = []
+    while len(events) < n:
+      kind = (await resp.content.readline()).decode().strip()
+      if not kind.startswith('event: '): continue
+      data = (await resp.content.readline()).decode().strip()
+      events.append((kind[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+  async def listening(uid):
+    while uid not in hub.listeners: await asyncio.sleep(0.01)
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    hub.event_keepalive = 0.05 # so a closed stream is noticed soon
+    await game.play()
+    (did, here), = hub.domains.items()
+    me = await game.login()
+    query = {'user':str(me['id']), 'secret':me['secret']}
+    async with game.client.get(game.hub_url+'/events', params=query) as resp:
+      assert resp.status == 200 and resp.content_type == 'text/event-stream'
+      await listening(me['id'])
+      await game.command(me, 'take', 'biomechtablet0')
+      hub.change('score', me['id'], did, 0.5)
+      (item, moved), (score, scored) = await read(resp, 2)
+      assert item == 'item' and moved['at'] == 'inventory' and moved['name'] == hub.templates[moved['item']]['name']
+      assert moved['item'] in hub.users[me['id']]['where']['inventory']
+      assert score == 'score' and scored == {'domain':did, 'points':0.5, 'total':0.5}
+    while me['id'] in hub.listeners: await asyncio.sleep(0.01)
+
+    hub.event_buffer = 2
+    dropped = metrics.counters.get(('hub_events_dropped_total', ()), 0)
+    async with game.client.get(game.hub_url+'/events', params=query) as resp:
+      await listening(me['id'])
+      for points in range(1, 6): # nothing is written out between these
+        hub.change('score', me['id'], did, points)
+      assert [data['points'] for _, data in await read(resp, 2)] == [4, 5], "the oldest are dropped"
+    assert metrics.counters[('hub_events_dropped_total', ())] == dropped + 3
+
+def test_leaderboard_ranks():
+  board = harness.fresh('hub').Leaderboard(size=8)
+  rng = random.Random(11)
+  points = {}
+  for _ in range(2000):
+    uid = rng.randrange(60)
+    points[uid] = rng.choice((0, 0.5, 1, 3, rng.randrange(40)/4, rng.randrange(1000)/100))
+    board.update(uid, points[uid])
+  for uid, mine in points.items():
+    assert board.rank(uid) == 1 + sum(p > mine for p in points.values())
+    assert board.above(mine) == sum(p > mine for p in points.values())
+  expect = sorted(points.values(), reverse=True)
+  top = board.top(25)
+  assert [entry['points'] for entry in top] == expect[:25]
+  assert all(entry['rank'] == board.rank(entry['user']) for entry in top)
+
+async def test_websocket_survives_errors(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    await game.play()
+    me = await game.login()
+    body = {'user':me['id'], 'secret':me['secret'], 'command':['inventory']}
+    run_command = game.hub.run_command
+    async def broken(data, app): raise ValueError('broken')
+    async with game.client.ws_connect(game.hub_url+'/ws') as ws:
+      game.hub.run_command = broken
+      await ws.send_json({'id':1, 'to':'hub', 'body':body})
+      assert (await ws.receive_json())['status'] == 500
+      game.hub.run_command = run_command
+      await ws.send_json({'id':2, 'to':'hub', 'body':body})
+      answer = await ws.receive_json()
+      assert answer['id'] == 2 and answer['status'] == 200
+
+async def test_rate_limit(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    game.hub.rate_limits['command'] = (20.0, 3)
+    await game.play()
+    me = await game.login()
+    body = {'user':me['id'], 'secret':me['secret'], 'command':['inventory']}
+    for _ in range(3):
+      async with game.client.post(game.hub_url+'/command', json=body) as resp:
+        assert resp.status == 200
+    async with game.client.post(game.hub_url+'/command', json=body) as resp:
+      assert resp.status == 429 and resp.headers['Retry-After'] == '1'
+      wait = (await resp.json())['retry_after']
+    assert 0 < wait <= 0.05
+    await asyncio.sleep(wait)
+    async with game.client.post(game.hub_url+'/command', json=body) as resp:
+      assert resp.status == 200, "a token refilled"
+
+def test_codec_negotiation():
+  import codec
+  from aiohttp.test_utils import make_mocked_request
+  data = {'user':12, 'carried':[{'name':'café', 'id':3, 'verb':{}}], 'score':1.5, 'none':None}
+  for kind in codec.available:
+    assert codec.decode(codec.encode(data, kind), kind) == data
+    assert codec.pick([kind, codec.JSON]) == kind
+    resp = codec.respond(make_mocked_request('GET', '/', headers={'Accept':codec.headers(kind)['Accept']}), data)
+    assert resp.content_type == kind and codec.decode(resp.body, kind) == data
+  assert codec.pick([]) == codec.JSON
+  assert codec.decode(b'{"a": 1}', 'text/plain') == {'a':1}
+  try:
+    with pytest.MonkeyPatch.context() as mp:
+      for name in 'msgpack', 'cbor2':
+        mp.setitem(sys.modules, name, None) # as if not installed
+      importlib.reload(codec)
+      assert codec.available == [codec.JSON]
+      assert codec.pick([codec.MSGPACK, codec.CBOR]) == codec.JSON
+      resp = codec.respond(make_mocked_request('GET', '/', headers={'Accept':codec.MSGPACK}), data)
+      assert resp.content_type == codec.JSON and codec.loads(resp.body) == data
+  finally:
+    importlib.reload(codec)
+
+async def test_codec_between_servers(aiohttp_client):
+  import codec
+  async with harness.InProcess('newdomain') as game:
+    await game.play()
+    (did, here), = game.hub.domains.items()
+    assert here['codecs'] == codec.available
+    assert game.domain.base_domain_info['codec'] == codec.available[0]
+    assert game.runners[0].app.links[did].kind == codec.available[0]
+    me = await game.login() # /arrive, sent in the negotiated type
+    assert 'biomechtablet0' in await game.command(me, 'look')
+
+async def test_idle_eviction(aiohttp_client, tmp_path):
+  import metrics
+  counter = lambda name: metrics.counters.get((name, ()), 0)
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    assert hub.idle_store is None, "eviction is off unless configured"
+    hub.idle_store = hub.IdleStore(str(tmp_path))
+    await game.play()
+    (did, here), = hub.domains.items()
+    a, b = await game.login(), await game.login()
+    await game.command(a, 'take', 'biomechtablet0')
+    hub.change('score', b['id'], did, 0.5)
+    evicted, reloaded = counter('hub_users_evicted_total'), counter('hub_users_reloaded_total')
+
+    assert hub.evict(time.monotonic() + hub.idle_ttl + 1) == 2
+    assert not hub.users and hub.idle_store.count == 2
+    assert counter('hub_users_evicted_total') == evicted + 2
+    assert 'biomechtablet0' in await game.command(a, 'inventory'), "read back for a /command"
+    status, answer = await game.post(game.hub_url+'/query', {'domain':did, 'secret':here['secret'], 'user':b['id'], 'location':'inventory'})
+    assert status == 200 and answer == [], "read back for a /query"
+    assert set(hub.users) == {a['id'], b['id']}
+    assert counter('hub_users_reloaded_total') == reloaded + 2
+    assert hub.idle_users() == 0 and not list(hub.idle_store.records()), "nothing to recover without a journal"
+
+    hub.evict(time.monotonic() + hub.idle_ttl + 1)
+    hub.load_state(pickle.loads(pickle.dumps(hub.dump_state()))) # as on restart: the leaderboard still counts evicted users
+    assert not hub.users and hub.leaderboard.rank(b['id']) == 1 and hub.leaderboard.rank(a['id']) == 2
+    assert hub.idle_users() == 2
+
+    hub.journal = hub.Journal(str(tmp_path/'state'))
+    assert 'biomechtablet0' in await game.command(a, 'inventory')
+    assert hub.idle_users() == 1 and os.path.exists(hub.idle_store.name(a['id'])), "needed until a snapshot has a"
+    hub.journal.snapshot()
+    await hub.journal.idle()
+    assert not os.path.exists(hub.idle_store.name(a['id'])) and os.path.exists(hub.idle_store.name(b['id']))
+    await hub.journal.close()
+
+async def test_no_eviction_mid_command(aiohttp_client, tmp_path):
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    hub.idle_store = hub.IdleStore(str(tmp_path))
+    hub.max_resident = 1
+    await game.play()
+    me = await game.login()
+    inventory = hub.commands['inventory'].handler
+    running, go_on = asyncio.Event(), asyncio.Event()
+    async def slow(uid, rest, app):
+      running.set()
+      await go_on.wait()
+      hub.change('domstate', uid, 5)
+      return await inventory(uid, rest, app)
+    hub.commands['inventory'].handler = slow
+    task = asyncio.create_task(game.command(me, 'inventory'))
+    await running.wait()
+    await game.login()
+    assert hub.evict(time.monotonic() + hub.idle_ttl + 1) == 1, "only the user without a command running"
+    assert me['id'] in hub.users
+    go_on.set()
+    await task
+    assert hub.users[me['id']]['domstate'] == 5
+
+async def test_world_file(aiohttp_client, tmp_path):
+  path = str(tmp_path/'world.json')
+  async with harness.InProcess('newdomain') as game:
+    await game.play()
+    game.hub.save_world(path)
+    hub, domain = game.hub, game.domain
+    saved = {name:json.loads(json.dumps(getattr(hub, name), default=list)) for name in ('domains', 'templates')}
+    awards, token_key = dict(hub.awards), hub.token_key
+    registration = dict(domain.base_domain_info)
+    url = game.domain_url
+
+  hub = harness.fresh('hub')
+  hub.preload(path)
+  assert hub.mode == 'play' and hub.token_key == token_key and hub.awards == awards
+  assert {name:json.loads(json.dumps(getattr(hub, name), default=list)) for name in saved} == saved
+  domain = harness.fresh('newdomain')
+  domain.whoami = url
+  domain.preload(path)
+  assert domain.base_domain_info == registration
+
+  with open(path) as f:
+    world = json.load(f)
+  broken = [
+    (lambda w: w['domains'][0].pop('secret'), 'needs a string "secret"'),
+    (lambda w: w['domains'][0].pop('items'), 'needs a list of "items"'),
+    (lambda w: w['domains'][0]['loot'].append(999999), 'loot 999999 is not an item id'),
+    (lambda w: w['outside'][0].pop('id'), 'every item needs an integer "id"'),
+  ]
+  for spoil, problem in broken:
+    bad = json.loads(json.dumps(world))
+    spoil(bad)
+    with open(path, 'w') as f:
+      json.dump(bad, f)
+    with pytest.raises(SystemExit, match=re.escape(problem)):
+      harness.fresh('hub').preload(path)
+  with open(path, 'w') as f:
+    f.write('{"domains": [')
+  with pytest.raises(SystemExit, match='Cannot read world file'):
+    harness.fresh('hub').preload(path)
+  with pytest.raises(SystemExit, match='Cannot read world file'):
+    domain.preload(path)
+
+async def test_router_world(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    await game.play()
+    assert hub.unpack_world(hub.pack_world()) == hub.dump_world()
+    router = hub.Router([])
+    app = aiohttp.web.Application()
+    app.router.add_route('*', '/{tail:.*}', router.route)
+    client = await aiohttp_client(app)
+    for method, path in ('GET', '/_world'), ('POST', '/_world'), ('POST', '/_message'):
+      resp = await client.request(method, path, data=b'')
+      assert resp.status == 404
+
+def test_router_owner():
+  owner = harness.fresh('hub').Router.owner
+  assert owner(b'{"user": 5, "token": "7.1.x"}') == 5
+  assert owner(b'{"token": "7.1.x", "command": ["score"]}') == 7
+  assert owner(b'{"token": "\\u00b2.1.x"}') is None and owner(b'[1]') is None and owner(b'nonsense') is None
+  import codec
+  for kind in codec.available:
+    assert owner(codec.encode({'user':9, 'item':3}, kind), kind) == 9
+
+async def test_journey_budget(aiohttp_client):
+  import metrics
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    hub.journey_budget = 0.2
+    await game.play()
+    me = await game.login()
+    await game.command(me, 'take', 'biomechtablet0')
+    arrive, gate, calls = hub.arrive, asyncio.Event(), []
+    async def slow(uid, dest, app, src='login'):
+      calls.append(uid)
+      await gate.wait()
+      return await arrive(uid, dest, app, src)
+    hub.arrive = slow
+    start = time.monotonic()
+    assert 'You travel' in await game.command(me, 'journey', 'north')
+    assert time.monotonic() - start < 0.5 and me['id'] in hub.pending, "answered within the budget"
+    drop = asyncio.create_task(game.command(me, 'drop', 'biomechtablet0'))
+    await asyncio.sleep(0.05)
+    assert not drop.done(), "drop waits for the journey to settle"
+    gate.set()
+    assert 'dropped' in await drop
+    assert me['id'] not in hub.pending and calls == [me['id']]
+
+    async def refused(uid, dest, app, src='login'):
+      calls.append(uid)
+      await asyncio.sleep(0.3)
+      return False
+    hub.arrive = refused
+    unfinished = metrics.counters.get(('hub_journeys_unfinished_total', ()), 0)
+    queue = asyncio.Queue()
+    hub.listeners[me['id']] = {queue:None}
+    await game.command(me, 'journey', 'north')
+    kind, data = await asyncio.wait_for(queue.get(), 2)
+    assert kind == 'journey' and data['arrived'] is False
+    assert len(calls) == 3, "one retry"
+    assert metrics.counters[('hub_journeys_unfinished_total', ())] == unfinished + 1
+    assert me['id'] not in hub.pending
+
+async def test_two_domains(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    hub, other = game.hub, harness.fresh('domain')
+    other.whoami = await game.serve(other.make_app())
+    status, answer = await game.post(game.hub_url+'/domain', other.whoami)
+    assert status == 200, answer
+    await game.play() # registers newdomain too
+    assert len(hub.domains) == 2 and not hub.others_items
+    for did, ways in hub.exits.items():
+      for way, there in ways.items():
+        assert hub.exits[there][hub.opposite[way]] == did, "exits are symmetric"
+    for tid, item in hub.templates.items():
+      if 'depth' in item:
+        assert item['hosts'] and item['home'] not in item['hosts'], "loot is hosted elsewhere"
+
+    me = await game.login()
+    here = hub.users[me['id']]['in']
+    (way, there), = hub.exits[here].items()
+    assert hub.domains[there]['name'] in await game.command(me, 'region')
+    edge = next(w for w in hub.headings if w not in hub.exits[here])
+    assert await game.command(me, 'journey', edge) == f'There is no domain to the {edge} of here.'
+    assert hub.users[me['id']]['in'] == here
+    assert 'You journey '+way in await game.command(me, 'journey', way)
+    assert hub.users[me['id']]['in'] == there
+
+async def test_circuit_breaker(aiohttp_client):
+  async with harness.InProcess('newdomain') as game:
+    hub = game.hub
+    hub.breaker_threshold, hub.breaker_cooldown = 2, 0.1
+    await game.play()
+    me = await game.login()
+    await game.command(me, 'take', 'biomechtablet0')
+    link, = game.runners[0].app.links.values()
+    url, link.url = link.url, 'http://127.0.0.1:1' # refuses connections
+    for _ in range(hub.breaker_threshold):
+      assert 'won\'t let you' in await game.command(me, 'drop', 'biomechtablet0')
+    assert link.degraded
+    assert 'not responding' in await game.command(me, 'drop', 'biomechtablet0'), "fails fast while open"
+
+    await asyncio.sleep(hub.breaker_cooldown)
+    link.url = url
+    async def call():
+      try:
+        async with link.post('/healthz') as resp: return str(resp.status)
+      except hub.DomainDegraded: return 'degraded'
+    assert sorted(await asyncio.gather(call(), call())) == ['405', 'degraded'], "one trial while half-open"
+    assert not link.degraded
+    assert 'dropped' in await game.command(me, 'drop', 'biomechtablet0')
+
+def test_harness_child_exits():
+  start = time.monotonic()
+  with pytest.raises(RuntimeError, match='exited'):
+    with harness.Subprocesses('no-such-domain.py', timeout=30):
+      pass
+  assert time.monotonic() - start < 10, "gave up without waiting for the timeout"
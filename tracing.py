@@ -0,0 +1,142 @@
+"""Trace ids carried from the hub to the domains, and per-request span trees served at /traces
+
+Each incoming request gets a root span, named after its route, whose trace id
+comes from its X-Trace-Id header or is made up if it has none. Spans opened
+while handling it, including one per outbound call made through a ClientSession
+given client_trace(), become its children. Outbound calls carry the trace id and
+their span id in headers, so the spans a domain records for a call can be
+matched with the hub's. Every response echoes the trace id.
+"""
+from aiohttp import web, TraceConfig
+import codec
+import collections
+import contextlib
+import contextvars
+import secrets
+import time
+
+TRACE_HEADER = 'X-Trace-Id'
+PARENT_HEADER = 'X-Parent-Span'
+
+# Most recent finished requests kept for /traces, oldest dropped first
+recent = collections.deque(maxlen=1000) # root Spans
+
+# Requests about the server itself, or connections too long-lived to be worth a trace
+quiet = {'/traces', '/metrics', '/healthz', '/readyz'}
+
+current = contextvars.ContextVar('span', default=None) # the innermost open Span
+
+
+class Span:
+    """A timed step of handling one request"""
+    __slots__ = ('trace', 'id', 'parent', 'name', 'start', 'took', 'children')
+
+    def __init__(self, trace:str, name:str, parent:str|None=None):
+        self.trace = trace
+        self.id = secrets.token_hex(4)
+        self.parent = parent # span id, possibly one recorded by another server
+        self.name = name
+        self.start = time.time()
+        self.took = None # seconds, once finished
+        self.children = []
+
+    def child(self, name:str) -> 'Span':
+        span = Span(self.trace, name, self.id)
+        self.children.append(span)
+        return span
+
+    def finish(self) -> None:
+        self.took = time.time() - self.start
+
+    def as_dict(self) -> dict:
+        return {'trace':self.trace, 'span':self.id, 'parent':self.parent, 'name':self.name, 'start':self.start,
+            'ms':None if self.took is None else round(self.took*1000, 3),
+            'children':[child.as_dict() for child in self.children]}
+
+
+@contextlib.contextmanager
+def root(name:str, trace:str|None=None, parent:str|None=None, record:bool=True):
+    """Opens the root span of a request, or of a message on a long-lived connection"""
+    me = Span(trace or secrets.token_hex(8), name, parent)
+    token = current.set(me)
+    try:
+        yield me
+    finally:
+        current.reset(token)
+        me.finish()
+        if record: recent.append(me)
+
+@contextlib.contextmanager
+def span(name:str):
+    """Times the enclosed code as a child of the current span; does nothing outside a request"""
+    parent = current.get()
+    if parent is None:
+        yield None
+        return
+    me = parent.child(name)
+    token = current.set(me)
+    try:
+        yield me
+    finally:
+        current.reset(token)
+        me.finish()
+
+
+def client_trace() -> TraceConfig:
+    """Makes each request of a ClientSession a child span carrying the trace headers"""
+    trace = TraceConfig()
+    async def start(session, ctx, params):
+        parent = current.get()
+        ctx.span = parent and parent.child(params.method+' '+params.url.path)
+        if ctx.span is not None:
+            params.headers[TRACE_HEADER] = ctx.span.trace
+            params.headers[PARENT_HEADER] = ctx.span.id
+    async def end(session, ctx, params):
+        if ctx.span is not None: ctx.span.finish()
+    trace.on_request_start.append(start)
+    trace.on_request_end.append(end)
+    trace.on_request_exception.append(end)
+    return trace
+
+
+@web.middleware
+async def middleware(req:web.Request, handler) -> web.StreamResponse:
+    """Opens the root span of each request and echoes its trace id"""
+    resource = req.match_info.route.resource
+    with root(req.method+' '+(resource.canonical if resource is not None else req.path),
+            req.headers.get(TRACE_HEADER), req.headers.get(PARENT_HEADER), req.path not in quiet) as me:
+        try:
+            resp = await handler(req)
+            resp.headers[TRACE_HEADER] = me.trace
+            return resp
+        except web.HTTPException as ex:
+            ex.headers[TRACE_HEADER] = me.trace
+            raise
+
+async def serve(req:web.Request) -> web.Response:
+    """Span trees of recent requests, newest first
+
+    Query parameters, all optional:
+    trace: only requests with this trace id
+    min_ms: only requests that took at least this long
+    limit: most trees to return (default 50)
+    """
+    try:
+        min_ms = float(req.query.get('min_ms', 0))
+        limit = int(req.query.get('limit', 50))
+    except ValueError:
+        return codec.json_response(status=400, data={"error":"min_ms must be a number and limit an integer"})
+    trace = req.query.get('trace')
+    found = []
+    for root in reversed(recent):
+        if len(found) >= limit: break
+        if trace is not None and root.trace != trace: continue
+        if root.took*1000 < min_ms: continue
+        found.append(root.as_dict())
+    return codec.json_response(data=found)
+
+
+def setup(app:web.Application) -> None:
+    """Adds a root span to every request and a GET /traces route to an app that is not yet running"""
+    app.middlewares.append(middleware)
+    app.router.add_get('/traces', serve)